@@ -1,10 +1,35 @@
-from arcgis.gis import GIS
-from arcgis.features import FeatureLayerCollection, FeatureSet, Table, Feature
 import tempfile
 import shutil
 import json
 import csv
 import os
+import uuid
+from lazy_import import lazy_import
+
+arcgis_gis = lazy_import("arcgis.gis")
+
+
+def stage_file(source_path, staged_path):
+    """Makes source_path available at staged_path as cheaply as possible: a
+    hardlink, else a symlink, else a copy."""
+
+    try:
+        os.link(source_path, staged_path)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(source_path), staged_path)
+        return
+    except OSError:
+        pass
+    shutil.copyfile(source_path, staged_path)
+
+
+class AppendOutcomeUnknown(Exception):
+    """The append request itself failed, e.g. timed out, so it isn't known
+    whether the server applied it."""
+    pass
 
 
 class AGOLConnection(object):
@@ -48,7 +73,7 @@ class AGOLConnection(object):
         password = self.creds['password']
         host = self.creds['host']
 
-        return GIS(host, username, password)
+        return arcgis_gis.GIS(host, username, password)
 
     def get_arcgis_feature_collection_from_item_id(self, arcgis_item_id):
 
@@ -97,29 +122,29 @@ class AGOLConnection(object):
         # share the underlying CSV with everyone.
         result = ""
 
+        # the file is staged under its original name in a directory of its
+        # own and passed by full path, so nothing depends on the working
+        # directory and several overwrites can run at once
         with tempfile.TemporaryDirectory() as tmpdirname:
-            shutil.copyfile(os.path.join(source_data_dir, source_data_file),
-                            os.path.join(tmpdirname, original_file_name))
+            staged_path = os.path.join(tmpdirname, original_file_name)
+            stage_file(os.path.join(source_data_dir, source_data_file), staged_path)
 
             if self.verbose:
                 print(f"   local CSV file name: {source_data_dir}/{source_data_file}")
-            original_dir = os.getcwd()
-            os.chdir(tmpdirname)
             if dry_run is False:
                 try:
                     if self.verbose:
                         print("    starting upload...")
-                    result = fs.manager.overwrite(original_file_name)
+                    result = fs.manager.overwrite(staged_path)
                 except Exception as e:
                     if self.verbose:
                         print(f"Caught exception {e} during upload, retrying")
-                    result = fs.manager.overwrite(original_file_name)
+                    result = fs.manager.overwrite(staged_path)
                 if self.verbose:
                     print("        finished.")
             else:
                 if self.verbose:
                     result = "Dry run complete"
-            os.chdir(original_dir)
         return result
 
     def get_already_processed_files(self, dataset_name):
@@ -142,3 +167,59 @@ class AGOLConnection(object):
 
         filenames_to_not_sftp = [f.attributes["Source_Filename"] for f in qr.features]
         return filenames_to_not_sftp
+
+    def get_loadable_fields(self, t):
+        """Names of the fields of table/layer t that data can be loaded into,
+        i.e. all but the ones the service maintains itself."""
+
+        system_types = ["esriFieldTypeOID", "esriFieldTypeGlobalID"]
+        return [f["name"] for f in t.properties.fields if f["type"] not in system_types]
+
+    def append_csv(self, t, csv_path, latitude_field=None, longitude_field=None):
+        """Loads every row of csv_path into table/layer t with one server-side
+        append, instead of sending the rows as JSON through edit_features.
+        The CSV is staged as a temporary item and deleted afterwards. Its
+        columns are mapped onto the fields of t by name. For a layer with
+        geometry, latitude_field and longitude_field name the coordinate
+        columns.
+
+        The append is rolled back if any row fails, so a result other than
+        True means nothing was added, as does an exception raised before the
+        append is sent. If the append request raises, AppendOutcomeUnknown is
+        raised instead."""
+
+        with open(csv_path, newline="") as csvfile:
+            columns = next(csv.reader(csvfile))
+        field_mappings = [{"name": name, "source": name} for name in self.get_loadable_fields(t) if name in columns]
+
+        if self.verbose:
+            print(f"   staging {csv_path} for append")
+        item = self.gis.content.add({
+            "type": "CSV",
+            "title": f"append_staging_{uuid.uuid4().hex}",
+            "tags": "staging",
+        }, data=csv_path)
+        try:
+            if t.properties.get("geometryType") is None:
+                analyzed = self.gis.content.analyze(item=item.id, file_type="csv", location_type="none")
+                source_info = analyzed["publishParameters"]
+            else:
+                analyzed = self.gis.content.analyze(item=item.id, file_type="csv", location_type="coordinates")
+                source_info = analyzed["publishParameters"]
+                source_info["latitudeFieldName"] = latitude_field
+                source_info["longitudeFieldName"] = longitude_field
+
+            if self.verbose:
+                print(f"   appending {len(field_mappings)} mapped field(s)...")
+            try:
+                result = t.append(item_id=item.id, upload_format="csv", field_mappings=field_mappings,
+                                  source_info=source_info, upsert=False, rollback=True)
+            except Exception as e:
+                raise AppendOutcomeUnknown(str(e)) from e
+        finally:
+            # failing to clean up must not look like a failed append
+            try:
+                item.delete()
+            except Exception as e:
+                print(f"Couldn't delete staging item {item.id}: {e}")
+        return result
@@ -0,0 +1,166 @@
+import math
+import numbers
+import calendar
+from datetime import datetime, timedelta
+
+INTEGER_TYPES = ["esriFieldTypeSmallInteger", "esriFieldTypeInteger", "esriFieldTypeBigInteger"]
+DOUBLE_TYPES = ["esriFieldTypeSingle", "esriFieldTypeDouble"]
+DATE_TYPES = ["esriFieldTypeDate"]
+STRING_TYPES = ["esriFieldTypeString", "esriFieldTypeGUID"]
+# maintained by the service; never sent
+SYSTEM_TYPES = ["esriFieldTypeOID", "esriFieldTypeGlobalID"]
+
+
+def is_null(v):
+    if v is None or (isinstance(v, str) and v == ""):
+        return True
+    # NaN, including numpy's, and pandas' NaT are the values not equal to
+    # themselves
+    try:
+        return bool(v != v)
+    except TypeError:
+        # pandas' NA can't be compared at all
+        return True
+
+
+def to_double(v):
+    if is_null(v):
+        return None
+    try:
+        v = float(v)
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(v) or math.isinf(v):
+        return None
+    return v
+
+
+def to_integer(v):
+    if is_null(v):
+        return None
+    if isinstance(v, numbers.Integral):
+        return int(v)
+    if isinstance(v, str):
+        try:
+            return int(v)
+        except ValueError:
+            pass
+    # e.g. "3.0", as pandas writes integer columns that had blanks; a value
+    # with a fraction isn't truncated but sent as null
+    v = to_double(v)
+    if v is None or not v.is_integer():
+        return None
+    return int(v)
+
+
+def to_epoch_ms(v):
+    """Dates are sent as milliseconds since the epoch. Naive datetimes and
+    ISO strings are taken to be UTC, as the source timestamps are."""
+
+    if is_null(v):
+        return None
+    if isinstance(v, str):
+        try:
+            v = datetime.fromisoformat(v.strip())
+        except ValueError:
+            return None
+    if isinstance(v, datetime):
+        return calendar.timegm(v.utctimetuple()) * 1000 + v.microsecond // 1000
+    return to_integer(v)
+
+
+def make_string_coercer(length):
+    def to_string(v):
+        if is_null(v):
+            return None
+        v = str(v)
+        if length is not None and length > 0:
+            v = v[:length]
+        return v
+    return to_string
+
+
+def compile_coercer(field):
+    """The function that converts a value to what field holds, or None for
+    fields that aren't sent."""
+
+    field_type = field.get("type")
+    if field_type in SYSTEM_TYPES:
+        return None
+    if field_type in INTEGER_TYPES:
+        return to_integer
+    if field_type in DOUBLE_TYPES:
+        return to_double
+    if field_type in DATE_TYPES:
+        return to_epoch_ms
+    if field_type in STRING_TYPES:
+        return make_string_coercer(field.get("length"))
+    # anything else is passed through, with blanks as nulls
+    return lambda v: None if is_null(v) else v
+
+
+class FeatureSchema(object):
+    """Coercion plan for the attributes sent to a hosted table or layer,
+    compiled once from its t.properties.fields. Values are converted to the
+    field's type (ints, doubles, dates as epoch milliseconds, strings cut to
+    the field length), blanks and NaN become nulls, and keys the table has no
+    field for are dropped. A key may be a field's name or its alias.
+
+    A value that can't be converted is sent as null rather than having the
+    service reject the whole row."""
+
+    def __init__(self, fields):
+        self.columns = []
+        self.date_fields = []
+        for field in fields:
+            coerce = compile_coercer(field)
+            if coerce is None:
+                continue
+            alias = field.get("alias")
+            if alias == field["name"]:
+                alias = None
+            self.columns.append((field["name"], alias, coerce))
+            if coerce is to_epoch_ms:
+                self.date_fields.append(field["name"])
+
+    def serialize_csv_batch(self, rows):
+        """serialize_batch() for rows written to a CSV that is loaded with an
+        append: the same fields and values, except that dates are written as
+        UTC timestamps, which the CSV analysis recognizes as dates."""
+
+        serialized = self.serialize_batch(rows)
+        epoch = datetime(1970, 1, 1)
+        for name in self.date_fields:
+            for attributes in serialized:
+                if attributes.get(name) is not None:
+                    attributes[name] = (epoch + timedelta(milliseconds=attributes[name])).isoformat(sep=" ")
+        return serialized
+
+    def get_field(self, key):
+        """(name, coerce) for the field key is a name or alias of, or None."""
+
+        for name, alias, coerce in self.columns:
+            if key == name or key == alias:
+                return (name, coerce)
+        return None
+
+    def serialize_batch(self, rows):
+        """Returns the attribute dicts to send for rows, converting a column
+        at a time."""
+
+        present = set()
+        for row in rows:
+            present.update(row.keys())
+
+        serialized = [{} for row in rows]
+        for name, alias, coerce in self.columns:
+            if name in present:
+                key = name
+            elif alias is not None and alias in present:
+                key = alias
+            else:
+                continue
+            values = [coerce(row.get(key)) for row in rows]
+            for attributes, value in zip(serialized, values):
+                attributes[name] = value
+        return serialized
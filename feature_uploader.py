@@ -0,0 +1,189 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from lazy_import import lazy_import
+
+arcgis_features = lazy_import("arcgis.features")
+
+
+def estimate_row_bytes(attributes):
+    """Rough size of a row in the edit_features JSON payload."""
+
+    return sum(len(k) + len(str(v)) + 6 for k, v in attributes.items())
+
+
+class FeatureUploader(object):
+    """Adds rows to a hosted table or layer with edit_features while they are
+    still being read. Rows are grouped into batches and several batches are
+    uploaded at once, up to max_concurrency. add() blocks once twice that
+    many batches are waiting or in flight, so memory stays bounded however
+    many rows are added.
+
+    Batches are closed at batch_size rows or max_payload_bytes, whichever
+    comes first. batch_size then adapts to how long requests take: it halves
+    when a request takes longer than target_latency and grows when requests
+    come back in less than half of it. Rows the service reports as failed
+    are retried on their own, up to max_retries times.
+
+    A request that raises may still have been applied (e.g. it timed out on
+    our side), and adds aren't idempotent, so it is never sent again: its
+    rows are kept in unknown_rows and nothing more is sent. The batches not
+    sent yet and any rows added afterwards are kept in unsent_rows, and
+    close() raises the error, so the caller can settle the rows whose
+    outcome is unknown and retry the ones that were never sent."""
+
+    def __init__(self, table, batch_size=1000, max_concurrency=4, max_retries=2, min_batch_size=100,
+                 max_batch_size=5000, max_payload_bytes=4 * 1024 * 1024, target_latency=15.0, retry_delay=2.0,
+                 schema=None, verbose=False):
+        self.table = table
+        # an optional FeatureSchema the rows are converted with before sending
+        self.schema = schema
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.max_payload_bytes = max_payload_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # batches in flight plus batches waiting for a thread
+        self.pending = threading.BoundedSemaphore(2 * max_concurrency)
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_bytes = 0
+
+        self.num_batches = 0
+        self.num_added = 0
+        self.num_retried = 0
+        # attributes of the rows the service didn't add
+        self.failed_rows = []
+        # rows of requests that raised, which may or may not have been added
+        self.unknown_rows = []
+        # rows never sent because an error stopped the upload
+        self.unsent_rows = []
+        self.error = None
+
+    def add(self, attributes):
+        """Queues a row for upload; blocks while too many batches are pending.
+        After an error the row is only kept in unsent_rows."""
+
+        if self.error is not None:
+            with self.lock:
+                self.unsent_rows.append(attributes)
+            return
+        self.batch.append(attributes)
+        self.batch_bytes += estimate_row_bytes(attributes)
+        if len(self.batch) >= self.batch_size or self.batch_bytes >= self.max_payload_bytes:
+            self._flush()
+
+    def _flush(self):
+        if len(self.batch) == 0:
+            return
+        batch = self.batch
+        self.batch = []
+        self.batch_bytes = 0
+        self.pending.acquire()
+        try:
+            self.executor.submit(self._run, batch)
+        except BaseException:
+            self.pending.release()
+            raise
+
+    def _run(self, batch):
+        try:
+            # after an error the remaining batches are kept, not uploaded
+            if self.error is None:
+                self._upload(batch)
+            else:
+                with self.lock:
+                    self.unsent_rows.extend(batch)
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+        finally:
+            self.pending.release()
+
+    def _upload(self, batch):
+        rows = batch
+        attempt = 0
+        try:
+            while True:
+                attributes = rows if self.schema is None else self.schema.serialize_batch(rows)
+                features = [arcgis_features.Feature(attributes=a) for a in attributes]
+                start = time.perf_counter()
+                try:
+                    status = self.table.edit_features(adds=features)
+                except Exception as e:
+                    print(f"edit_features failed ({e}); {len(rows)} features may or may not have been added")
+                    with self.lock:
+                        self.unknown_rows.extend(rows)
+                    rows = []
+                    raise
+                self._adapt(time.perf_counter() - start, len(rows))
+
+                results = status.get("addResults", [])
+                # a row without a result wasn't added either
+                failed = [row for i, row in enumerate(rows) if i >= len(results) or not results[i]["success"]]
+                with self.lock:
+                    self.num_batches += 1
+                    self.num_added += len(rows) - len(failed)
+
+                if len(failed) == 0:
+                    if self.verbose:
+                        print(f"All {len(rows)} features successfull updated in this batch.")
+                    return
+                print(f"Not all updates succeeded; {len(failed)} failures")
+                if attempt >= self.max_retries:
+                    with self.lock:
+                        self.failed_rows.extend(failed)
+                    return
+                rows = failed
+                attempt += 1
+                with self.lock:
+                    self.num_retried += len(rows)
+                time.sleep(self.retry_delay * attempt)
+        except BaseException:
+            # rows not sent when something else failed
+            with self.lock:
+                self.unsent_rows.extend(rows)
+            raise
+
+    def _adapt(self, latency, num_rows):
+        with self.lock:
+            if latency > self.target_latency:
+                self.batch_size = max(self.min_batch_size, self.batch_size // 2)
+            elif latency < self.target_latency / 2 and num_rows >= self.batch_size:
+                # only full batches say anything about how big batches can get
+                self.batch_size = min(self.max_batch_size, self.batch_size * 3 // 2)
+
+    def close(self):
+        """Uploads what is left and waits for every batch. Returns the rows
+        that failed."""
+
+        if self.error is None:
+            self._flush()
+        else:
+            self._keep_unsent()
+        self.executor.shutdown(wait=True)
+        if self.error is not None:
+            raise self.error
+        return self.failed_rows
+
+    def abort(self):
+        """Stops without uploading the rows that haven't been sent yet."""
+
+        with self.lock:
+            if self.error is None:
+                self.error = RuntimeError("upload aborted")
+        self._keep_unsent()
+        self.executor.shutdown(wait=True)
+
+    def _keep_unsent(self):
+        with self.lock:
+            self.unsent_rows.extend(self.batch)
+        self.batch = []
+        self.batch_bytes = 0
@@ -1,33 +1,17 @@
 import os
+import sys
 import csv
-import json
 import glob
 from datetime import datetime
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from operators.utils import load_geojson
+
 hos_file = "HOS_locations.geojson"
 ltc_file = "LTC_locations.geojson"
 
 full_csv_dir = os.path.join("..", "..", "pa-csv-examples", "all-csvs")
 
-## this is now in operators.utils and should be removed from here once the
-## location matching is upgraded all around
-def load_geojson(filename, idfield):
-
-
-    with open(filename, "r") as f:
-        geojson = json.loads(f.read())
-
-    outdata = {}
-
-    for feature in geojson['features']:
-        name = feature['properties'].pop(idfield)
-        outdata[name] = feature['properties']
-        outdata[name]["long"] = feature['geometry']['coordinates'][0]
-        outdata[name]["lat"] = feature['geometry']['coordinates'][1]
-
-    print(f"{len(outdata)} features loaded")
-    return outdata
-
 def gather_lat_longs():
     """ needs to be cleaned up before this will really work
     it's just a copy/paste from elsewhere"""
@@ -1,6 +1,8 @@
-import geopy
-from geopy.geocoders import Nominatim
+import os
 import csv
+from lazy_import import lazy_import
+
+geopy_geocoders = lazy_import("geopy.geocoders")
 
 class Counties(object):
     def __init__(self):
@@ -60,7 +62,7 @@ class HospitalLocations(object):
         return cache
 
     def create_new_cache(self, hos_filename):
-        locator = Nominatim(user_agent="PAHOS")
+        locator = geopy_geocoders.Nominatim(user_agent="PAHOS")
         results = []
         errors = []
 
@@ -179,6 +181,57 @@ class HospitalLocations(object):
                 writer = csv.DictWriter(csvfile, fieldnames=errors[0].keys())
                 writer.writeheader()
                 writer.writerows(errors)
+class HospitalResolver(object):
+    """Maps a hospital name as it appears in a HOS file to a record with the
+    canonical name, latitude, longitude and county, so enrichment is a single
+    dict lookup per row. Results are memoized per raw name, misses included.
+    Use get_hospital_resolver() rather than constructing one directly."""
+
+    def __init__(self):
+        self.locations = HospitalLocations()
+        self.records = {}
+
+    def resolve(self, hos):
+        """Returns the record for hos, or None if there is no location
+        information for it."""
+
+        try:
+            return self.records[hos]
+        except KeyError:
+            pass
+
+        canonical_name = self.locations.get_canonical_name(hos)
+        loc = self.locations.get_location_for_hospital(canonical_name)
+        record = None
+        if loc is not None:
+            record = {
+                "HospitalName": canonical_name,
+                "HospitalLatitude": loc["HospitalLatitude"],
+                "HospitalLongitude": loc["HospitalLongitude"],
+                "HospitalCounty": loc["GeocodedHospitalCounty"],
+            }
+        self.records[hos] = record
+        return record
+
+
+# the process-wide resolver, and the geocode cache file state it was built from
+hospital_resolver = None
+hospital_resolver_cache_state = None
+
+def get_hospital_resolver():
+    """Returns the shared HospitalResolver, rebuilding it only if
+    geo_data/geocode_cache.csv has changed since it was loaded."""
+
+    global hospital_resolver, hospital_resolver_cache_state
+
+    st = os.stat("geo_data/geocode_cache.csv")
+    cache_state = (st.st_mtime_ns, st.st_size)
+    if hospital_resolver is None or cache_state != hospital_resolver_cache_state:
+        hospital_resolver = HospitalResolver()
+        hospital_resolver_cache_state = cache_state
+    return hospital_resolver
+
+
 # Example:
 #h = HospitalLocations()
 #h.create_new_cache("processed_HOS_HOS_ResourceCapacity_2020-04-09_15-00.csv")
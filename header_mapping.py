@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 
+import json
+import hashlib
+from types import MappingProxyType
+
+# lookups built from each mapping, shared by every HeaderMapping in the process
+mapping_lookups = {}
+
+
 class HeaderMapping(object):
     """Instantiate with either "HOS" or "LTC" to get header utils for each type
-    of CSV."""
+    of CSV. The lookups are built once per mapping type and are read-only, so
+    every instance can hand out the same objects."""
 
     def __init__(self, mapping_type):
         if mapping_type == "HOS":
@@ -12,68 +21,61 @@ class HeaderMapping(object):
         else:
             raise ValueError("HeaderMapping() requires positional argument 'HOS' or 'LTC'")
 
+        if mapping_type not in mapping_lookups:
+            mapping_lookups[mapping_type] = build_lookups(self.mapping)
+        self.lookups = mapping_lookups[mapping_type]
+
     def get_fieldname_lookup(self):
         """This lookup has aliases as keys and their corresponding short
         fieldnames as values."""
 
-        lookup = {}
-        for k, v in self.mapping.items():
-            for alias in v:
-                lookup[alias] = k
-
-        return lookup
+        return self.lookups["fieldname_lookup"]
 
     def get_alias_lookup(self):
         """This lookup has short fieldnames as keys and their preferred aliases
-        as values. Preferred alias is the first in the list in hos_mapping."""
-
-        lookup = {}
-        for k, v in self.mapping.items():
-            lookup[k] = v[0]
+        as values. Preferred alias is the first in the list in hos_mapping, or
+        the short fieldname itself if it has no aliases."""
 
-        return lookup
+        return self.lookups["alias_lookup"]
 
     def get_aliases(self):
-        """This is a list of all valid aliases. Most useful for testing."""
+        """This is a tuple of all valid aliases. Most useful for testing."""
 
-        values = []
-        for v in self.mapping.values():
-            values += v['aliases']
-        return values
+        return self.lookups["aliases"]
 
     def get_fieldnames(self):
-        """This is a list of all valid short fieldnames. Most useful for testing."""
+        """This is a tuple of all valid short fieldnames. Most useful for testing."""
 
-        return list(self.mapping.keys())
+        return self.lookups["fieldnames"]
 
     def get_fieldnames_and_aliases(self):
-        """Creates one big list of all fieldnames and all aliases."""
+        """One big frozenset of all fieldnames and all aliases."""
 
-        return self.get_fieldnames() + self.get_aliases()
+        return self.lookups["fieldnames_and_aliases"]
 
     def get_master_lookup(self):
         """This lookup has keys for all long names AND all short names. Each key
         corresponds to the proper short name. Allows a single point of entry for
         any header name."""
 
-        lookup = {}
-        for k, v in self.mapping.items():
-            lookup[k] = k
-            for alias in v['aliases']:
-                lookup[alias] = k
+        return self.lookups["master_lookup"]
+
+    def get_version(self):
+        """Hash of the mapping, for caches of anything derived from it."""
 
-        return lookup
+        return self.lookups["version"]
 
     def get_public_column_names(self):
         """returns the names of all columns in the mapping that have been marked
-        'public' = True"""
+        'public' = True, in mapping order"""
 
-        cols = list()
-        for k, v in self.mapping.items():
-            if v.get("public", False) is True:
-                cols.append(k)
+        return self.lookups["public_column_names"]
 
-        return cols
+    def get_public_column_set(self):
+        """The same names as get_public_column_names(), as a frozenset for
+        membership tests."""
+
+        return self.lookups["public_column_set"]
 
     def get_hos_supplies_mapping(self):
 
@@ -106,6 +108,37 @@ class HeaderMapping(object):
         return supplies_mapping
 
 
+def build_lookups(mapping):
+    """Builds the read-only lookups that HeaderMapping hands out."""
+
+    fieldname_lookup = {}
+    alias_lookup = {}
+    master_lookup = {}
+    aliases = []
+    public_column_names = []
+    for k, v in mapping.items():
+        master_lookup[k] = k
+        for alias in v['aliases']:
+            fieldname_lookup[alias] = k
+            master_lookup[alias] = k
+        aliases += v['aliases']
+        alias_lookup[k] = v['aliases'][0] if len(v['aliases']) > 0 else k
+        if v.get("public", False) is True:
+            public_column_names.append(k)
+
+    return {
+        "fieldname_lookup": MappingProxyType(fieldname_lookup),
+        "alias_lookup": MappingProxyType(alias_lookup),
+        "master_lookup": MappingProxyType(master_lookup),
+        "aliases": tuple(aliases),
+        "fieldnames": tuple(mapping.keys()),
+        "fieldnames_and_aliases": frozenset(mapping.keys()) | frozenset(aliases),
+        "public_column_names": tuple(public_column_names),
+        "public_column_set": frozenset(public_column_names),
+        "version": hashlib.sha256(json.dumps(mapping, sort_keys=True).encode("utf8")).hexdigest(),
+    }
+
+
 ltc_mapping = {}
 
 hos_mapping = {
@@ -1,52 +1,163 @@
 import os
+import io
 import csv
 import glob
 import math
-import pysftp
-import pandas as pd
+import tempfile
+import threading
+from contextlib import ExitStack
 from pprint import pprint
 from datetime import datetime, date, timedelta
+from concurrent.futures import ThreadPoolExecutor
 
 import header_mapping as hm
 from geo_utils import Counties
 from operators import process_csv
 from operators import get_datetime_from_filename
-from arcgis.features import FeatureLayerCollection, FeatureSet, Table, Feature
+from operators import hash_file
+from operators import atomic_write
+from operators.columnar import get_columnar_path, read_columnar
 from validator import ValidationError
-from agol_connection import AGOLConnection
+from agol_connection import AGOLConnection, AppendOutcomeUnknown
+from sync_manifest import SyncManifest
+from feature_uploader import FeatureUploader
+from feature_schema import FeatureSchema
+from lazy_import import lazy_import
 
+pd = lazy_import("pandas")
+pysftp = lazy_import("pysftp")
+arcgis_features = lazy_import("arcgis.features")
 
-def load_csv_to_df(csv_file_path):
+
+def load_csv_to_df(csv_file_path, usecols=None):
     try:
-        df = pd.read_csv(csv_file_path)
+        df = pd.read_csv(csv_file_path, usecols=usecols)
     except UnicodeDecodeError:
-        df = pd.read_csv(csv_file_path, encoding='cp1252')
+        df = pd.read_csv(csv_file_path, encoding='cp1252', usecols=usecols)
     return df
 
 
-def chunks(l, n):
-    for i in range(0, len(l), n):
-        yield l[i:i+n]
+def load_processed_df(processed_dir, processed_filename, columns=None):
+    """Loads a processed file, from its columnar intermediate if process_csv
+    wrote one, otherwise from the CSV. columns restricts what is read."""
+
+    csv_file_path = os.path.join(processed_dir, processed_filename)
+    columnar_path = get_columnar_path(csv_file_path)
+    if os.path.exists(columnar_path):
+        return read_columnar(columnar_path, columns=columns)
+    return load_csv_to_df(csv_file_path, usecols=columns)
+
+
+def historical_row_keys(rows):
+    """(source filename, hospital) for each historical table row, the keys
+    they have in the failure ledger. A hospital that appears more than once
+    in a file gets its occurrence number appended, so one failed row doesn't
+    overwrite another."""
+
+    hospital_name_column = hm.HeaderMapping("HOS").get_master_lookup()["HospitalName"]
+    seen = {}
+    keys = []
+    for row in rows:
+        key = (row["Source_Filename"], row.get(hospital_name_column) or "")
+        seen[key] = seen.get(key, 0) + 1
+        if seen[key] > 1:
+            key = (key[0], f"{key[1]} #{seen[key]}")
+        keys.append(key)
+    return keys
+
+
+def historical_row_key(row, schema):
+    """(source filename, hospital) as the historical table holds them, to
+    count a row against the rows in the table. Unlike the ledger keys these
+    are the same for every row of a hospital in a file."""
+
+    hospital_name_column = hm.HeaderMapping("HOS").get_master_lookup()["HospitalName"]
+    name, coerce = schema.get_field(hospital_name_column)
+    value = row[hospital_name_column] if hospital_name_column in row else row.get(name)
+    return (row["Source_Filename"], coerce(value) or "")
+
+
+def count_processed_rows(processed_dir, processed_file_details):
+    """Number of rows in the processed files, counted as lines without
+    parsing them; close enough to choose how to upload them."""
+
+    num_rows = 0
+    for f in processed_file_details:
+        with open(os.path.join(processed_dir, f["processed_filename"]), "rb") as csvfile:
+            num_lines = sum(block.count(b"\n") for block in iter(lambda: csvfile.read(1 << 20), b""))
+        # less the header
+        num_rows += max(num_lines - 1, 0)
+    return num_rows
+
+
+def iter_historical_rows(processed_dir, processed_file_details):
+    """Yields the rows of each processed file one at a time, tagged with the
+    file they came from, for the historical table."""
+
+    for f in processed_file_details:
+        fname = f["processed_filename"]
+        print(f"    working on {fname}..")
+        size = os.path.getsize(os.path.join(processed_dir, fname))
+        if size > 0:
+            processed_time = datetime.utcnow().isoformat()
+            with open(os.path.join(processed_dir, fname), newline='') as csvfile:
+                reader = csv.DictReader(csvfile)
+                for row in reader:
+
+                    row["Source_Data_Timestamp"] = f["source_datetime"].isoformat()
+                    row["Processed_At"] = processed_time
+                    row["Source_Filename"] = f["filename"]
+                    yield row
+
+        else:
+            print(f"{fname} has a filesize of {size}, not processing.")
 
 
-def create_summary_table_row(df, source_data_timestamp, source_filename):
-    new_row = {}
-    new_row["Source Data Timestamp"] = source_data_timestamp.isoformat()
-    new_row["Processed At"] = datetime.utcnow().isoformat()
-    new_row["Source Filename"] = source_filename
+def download_file_atomically(sftp, remote_filename, target_dir):
+    """Downloads remote_filename into target_dir via a temporary file that is
+    renamed into place once complete, so a partial download is never left
+    behind under the real filename."""
 
-    for pct_col_name, value in hm.summary_table_header.items():
-        pct = (df[value["n"]].sum() / df[value["d"]].sum()) * 100
+    target_path = os.path.join(target_dir, remote_filename)
+    with atomic_write(target_path, prefix=f".{remote_filename}.") as tmp_path:
+        sftp.get(remote_filename, tmp_path)
+    return target_path
+
+
+def get_summary_columns():
+    """The processed columns the summary table percentages are built from."""
+
+    columns = []
+    for value in hm.summary_table_header.values():
+        for k in [value["d"], value["n"]]:
+            if k not in columns:
+                columns.append(k)
+    return columns
 
-        new_row[value["d"]] = df[value["d"]].sum()
-        new_row[value["n"]] = df[value["n"]].sum()
-        new_row[pct_col_name] = pct
-    return new_row
+
+def create_summary_table(file_sums, file_details, processed_at):
+    """Builds the summary table from the column sums of each processed file,
+    one row per file, computing every percentage for all files at once. A
+    percentage with a zero denominator is NaN rather than inf."""
+
+    sums = pd.DataFrame(file_sums, columns=get_summary_columns())
+    summary_df = pd.DataFrame({
+        "Source Data Timestamp": [f["source_datetime"].isoformat() for f in file_details],
+        "Processed At": processed_at,
+        "Source Filename": [f["filename"] for f in file_details],
+    })
+    for pct_col_name, value in hm.summary_table_header.items():
+        d = sums[value["d"]]
+        n = sums[value["n"]]
+        summary_df[value["d"]] = d
+        summary_df[value["n"]] = n
+        summary_df[pct_col_name] = n / d.where(d != 0) * 100
+    return summary_df
 
 
 class Ingester(object):
 
-    def __init__(self, dry_run=False, verbose=False):
+    def __init__(self, dry_run=False, verbose=False, datadir=None):
 
         creds = self._load_credentials()
         if creds is None:
@@ -58,6 +169,13 @@ class Ingester(object):
         self.agol = agol_connection
         self.available_files = []
         self.verbose = verbose
+        # without a data dir there is nowhere to keep the sync manifest, so
+        # fall back to checking the target dir and ArcGIS on every run
+        self.manifest = None
+        if datadir is not None:
+            self.manifest = SyncManifest(datadir)
+        # SFTP session kept open for streaming reads; see open_sftp_file()
+        self.stream_sftp = None
 
     def _load_credentials(self):
 
@@ -75,23 +193,83 @@ class Ingester(object):
                     creds['host'] = row['host']
         return creds
 
-    def get_files_from_sftp(self, prefix="HOS_ResourceCapacity_", target_dir="/tmp",
-                                   only_latest=True, filenames_to_ignore=[], verbose=False):
-
+    def _make_sftp_connection(self):
         cnopts = pysftp.CnOpts()
         cnopts.hostkeys.load('copaftp.pub')
         username = self.creds['username']
         password = self.creds['password']
         host = self.creds['host']
+        return pysftp.Connection(host, username=username, password=password, cnopts=cnopts)
+
+    def _download_files_in_parallel(self, filenames, target_dir, connections):
+        """Downloads filenames into target_dir over a pool of `connections`
+        SFTP sessions. Each worker thread opens its own session on first use."""
+
+        local = threading.local()
+        sessions = []
+        sessions_lock = threading.Lock()
+
+        def download(f):
+            sftp = getattr(local, "sftp", None)
+            if sftp is None:
+                sftp = self._make_sftp_connection()
+                local.sftp = sftp
+                with sessions_lock:
+                    sessions.append(sftp)
+            download_file_atomically(sftp, f, target_dir)
+            if self.verbose:
+                print(f"Finished downloading {target_dir}/{f}")
+
+        try:
+            with ThreadPoolExecutor(max_workers=connections) as executor:
+                # list() so that any download exception is raised here
+                list(executor.map(download, filenames))
+        finally:
+            for sftp in sessions:
+                sftp.close()
+
+    def open_sftp_file(self, path):
+        """Opens the remote file named by the basename of path for streaming
+        reads, returning a text file object. Used in place of the local
+        opener so nothing is written to disk before processing. The SFTP
+        session is reused between calls until close_sftp() is called."""
+
+        if self.stream_sftp is None:
+            self.stream_sftp = self._make_sftp_connection()
+        remote_file = self.stream_sftp.open(os.path.basename(path), "rb")
+        # read ahead in the background instead of one round trip per block
+        remote_file.prefetch()
+        return io.TextIOWrapper(remote_file, encoding="utf8", newline="")
+
+    def close_sftp(self):
+        if self.stream_sftp is not None:
+            self.stream_sftp.close()
+            self.stream_sftp = None
+
+    def get_files_from_sftp(self, prefix="HOS_ResourceCapacity_", target_dir="/tmp",
+                                   only_latest=True, filenames_to_ignore=[], verbose=False,
+                                   connections=1, download=True):
+        """Downloads files starting with prefix into target_dir. With connections
+        greater than 1, files are fetched concurrently over that many SFTP
+        sessions; the returned file_details are in the same order either way.
+        With download=False only the file_details are
+        returned, for use with open_sftp_file()."""
+
         latest_filename = ""
         files = ""
         file_details = []
 
-        existing_files = glob.glob(target_dir + "/" + prefix + "*")
+        if self.manifest is None:
+            existing_files = glob.glob(target_dir + "/" + prefix + "*")
 
-        with pysftp.Connection(host, username=username, password=password, cnopts=cnopts) as sftp:
-            files = sftp.listdir()
-            files = [f for f in files if f.startswith(prefix)]
+        with self._make_sftp_connection() as sftp:
+            if self.manifest is None:
+                files = sftp.listdir()
+                files = [f for f in files if f.startswith(prefix)]
+            else:
+                attrs = [a for a in sftp.listdir_attr() if a.filename.startswith(prefix)]
+                attrs.sort(key=lambda a: a.filename)
+                files = [a.filename for a in attrs]
             # the files are sorted by the pysftp library, and the last element of the list is the latest file
             # Filenames look like HOS_ResourceCapacity_2020-03-30_00-00.csv
             # And timestamps are in UTC
@@ -101,6 +279,13 @@ class Ingester(object):
                 files_to_get = [latest_filename]
             else:
                 files_to_get = files
+            if self.manifest is not None:
+                wanted = set(files_to_get)
+                for a in attrs:
+                    if a.filename in wanted:
+                        self.manifest.record_remote_file(a.filename, a.st_size, a.st_mtime)
+            filenames_to_ignore = set(filenames_to_ignore)
+            files_to_download = []
             for f in files_to_get:
                 if f in filenames_to_ignore:
                     if self.verbose:
@@ -108,21 +293,187 @@ class Ingester(object):
                     continue
                 if self.verbose:
                     print(f"Getting: {f}")
-                if os.path.join(target_dir, f) not in existing_files:
-                    sftp.get(f, f'{target_dir}/{f}')
-                    if self.verbose:
-                        print(f"Finished downloading {target_dir}/{f}")
+                if not download:
+                    pass
+                elif self.manifest is None and os.path.join(target_dir, f) not in existing_files:
+                    files_to_download.append(f)
+                elif self.manifest is not None and not (self.manifest.is_downloaded(f) and
+                                                        os.path.exists(os.path.join(target_dir, f))):
+                    files_to_download.append(f)
                 else:
                     if self.verbose:
                         print(f"Didn't have to download {target_dir}/{f}; it already exists")
 
                 source_date = get_datetime_from_filename(f, prefix=prefix)
                 file_details.append({"dir": target_dir, "filename": f, "source_datetime": source_date})
+
+            if connections <= 1 or len(files_to_download) <= 1:
+                for f in files_to_download:
+                    download_file_atomically(sftp, f, target_dir)
+                    if self.verbose:
+                        print(f"Finished downloading {target_dir}/{f}")
+
+        if connections > 1 and len(files_to_download) > 1:
+            if self.verbose:
+                print(f"Downloading {len(files_to_download)} files over {connections} SFTP connections")
+            self._download_files_in_parallel(files_to_download, target_dir, connections)
+
+        if self.manifest is not None:
+            for f in files_to_download:
+                self.manifest.mark_downloaded(f, hash_file(os.path.join(target_dir, f)))
+
         return (file_details, files)
 
-    def get_already_processed_files(self, dataset_name):
+    def get_already_processed_files(self, dataset_name, include_failed=False):
+        """Filenames already published to dataset_name. Answered from the sync
+        manifest when it knows about the dataset; otherwise ArcGIS is queried
+        and the answer is used to seed the manifest. Files with rows in the
+        failure ledger are left out unless include_failed is True."""
+
+        if self.manifest is not None and self.manifest.has_dataset(dataset_name):
+            return self.manifest.get_published_files(dataset_name, include_failed=include_failed)
+
+        filenames = self.agol.get_already_processed_files(dataset_name)
+        if self.manifest is not None:
+            self.manifest.mark_published(dataset_name, self._file_details_for_filenames(filenames))
+        return filenames
 
-        return self.agol.get_already_processed_files(dataset_name)
+    def _file_details_for_filenames(self, filenames, prefix="HOS_ResourceCapacity_"):
+        details = []
+        for f in filenames:
+            try:
+                source_date = get_datetime_from_filename(f, prefix=prefix)
+            except ValueError:
+                source_date = None
+            details.append({"filename": f, "source_datetime": source_date})
+        return details
+
+    def _mark_published(self, dataset_name, file_details):
+        if self.manifest is not None and not self.dry_run:
+            self.manifest.mark_published(dataset_name, file_details)
+
+    def _record_failed_rows(self, dataset_name, rows, unknown_rows=[], expected_counts=None, schema=None):
+        """Puts rows that weren't added in the failure ledger, along with
+        unknown_rows, whose outcome is unknown, each with the count in
+        expected_counts for its historical_row_key()."""
+
+        if self.manifest is None or self.dry_run or len(rows) + len(unknown_rows) == 0:
+            return
+        # keyed together, so a failed and an unknown row of one hospital don't
+        # get the same key
+        keys = historical_row_keys(rows + unknown_rows)
+        self.manifest.record_failed_rows(dataset_name, [key + (row,) for key, row in zip(keys, rows)])
+        self.manifest.record_unknown_rows(
+            dataset_name, [key + (row, expected_counts.get(historical_row_key(row, schema), 0))
+                           for key, row in zip(keys[len(rows):], unknown_rows)])
+
+    def _count_historical_table_rows(self, t, schema, filenames):
+        """Rows in the historical table per historical_row_key(), for the
+        given source files."""
+
+        hospital_name_column = hm.HeaderMapping("HOS").get_master_lookup()["HospitalName"]
+        hospital_field, coerce = schema.get_field(hospital_name_column)
+        filenames = sorted(filenames)
+        counts = {}
+        # keeps the where clause a sensible length
+        for i in range(0, len(filenames), 100):
+            names = ", ".join("'" + f.replace("'", "''") + "'" for f in filenames[i:i + 100])
+            qr = t.query(where=f"Source_Filename IN ({names})", out_fields=f"Source_Filename,{hospital_field}",
+                         return_geometry=False)
+            for feature in qr.features:
+                key = (feature.attributes["Source_Filename"], feature.attributes.get(hospital_field) or "")
+                counts[key] = counts.get(key, 0) + 1
+        return counts
+
+    def retry_failed_historical_rows(self, upload_concurrency=4):
+        """Uploads the rows in the failure ledger for the historical table
+        again. Rows whose earlier upload has an unknown outcome are first
+        counted against the table, and only the ones it doesn't hold are
+        sent. Rows that make it are removed from the ledger; the rest stay
+        for the next run."""
+
+        if self.manifest is None:
+            return
+        failed = self.manifest.get_failed_rows("full_historical_table")
+        unknown = self.manifest.get_unknown_rows("full_historical_table")
+        if len(failed) + len(unknown) == 0:
+            return
+        print(f"Retrying {len(failed)} historical rows that failed to upload before, and checking "
+              f"{len(unknown)} that may not have been added...")
+        if self.dry_run:
+            if self.verbose:
+                print("Dry run set, not editing features.")
+            return
+
+        layer_conf = self.agol.layers['full_historical_table']
+        table = self.agol.gis.content.get(layer_conf['id'])
+        t = table.layers[0]
+        schema = FeatureSchema(t.properties.fields)
+
+        # counted before anything is sent: it tells which unknown rows were
+        # added, and is what the table holds besides any rows whose outcome
+        # becomes unknown below
+        counts = self._count_historical_table_rows(
+            t, schema, set(entry[0] for entry in failed) | set(entry[0] for entry in unknown))
+
+        if len(unknown) > 0:
+            # beyond the rows expected, the table holds the unknown rows that
+            # were added
+            landed = {}
+            for filename, hospital, attributes, expected in unknown:
+                key = historical_row_key(attributes, schema)
+                landed.setdefault(key, counts.get(key, 0) - expected)
+            added = []
+            missing = []
+            for filename, hospital, attributes, expected in unknown:
+                key = historical_row_key(attributes, schema)
+                if landed[key] > 0:
+                    landed[key] -= 1
+                    added.append((filename, hospital))
+                else:
+                    missing.append((filename, hospital, attributes))
+            self.manifest.clear_failed_rows("full_historical_table", added)
+            self.manifest.record_failed_rows("full_historical_table", missing)
+            print(f"{len(added)} of {len(unknown)} rows that may not have been added are in the table")
+            failed = failed + [(filename, hospital, attributes, None) for filename, hospital, attributes in missing]
+            if len(failed) == 0:
+                return
+
+        uploader = FeatureUploader(t, max_concurrency=upload_concurrency, schema=schema, verbose=self.verbose)
+        try:
+            for filename, hospital, attributes, attempts in failed:
+                uploader.add(attributes)
+        except BaseException:
+            uploader.abort()
+            raise
+        error = None
+        try:
+            uploader.close()
+        except Exception as e:
+            # the ones that were added still come out of the ledger
+            error = e
+
+        # the uploader hands back the same row objects, which keep their keys
+        not_added_ids = set(id(row) for row in uploader.failed_rows + uploader.unsent_rows)
+        unknown_ids = set(id(row) for row in uploader.unknown_rows)
+        confirmed = [entry for entry in failed if id(entry[2]) not in not_added_ids | unknown_ids]
+        self.manifest.clear_failed_rows("full_historical_table",
+                                        [(filename, hospital) for filename, hospital, attributes, attempts in confirmed])
+        self.manifest.record_failed_rows(
+            "full_historical_table", [(filename, hospital, attributes) for filename, hospital, attributes, attempts
+                                      in failed if id(attributes) in not_added_ids])
+        if len(unknown_ids) > 0:
+            expected = dict(counts)
+            for filename, hospital, attributes, attempts in confirmed:
+                key = historical_row_key(attributes, schema)
+                expected[key] = expected.get(key, 0) + 1
+            self.manifest.record_unknown_rows(
+                "full_historical_table", [(filename, hospital, attributes, expected.get(historical_row_key(attributes, schema), 0))
+                                          for filename, hospital, attributes, attempts in failed
+                                          if id(attributes) in unknown_ids])
+        print(f"{len(confirmed)} of {len(failed)} previously failed rows uploaded")
+        if error is not None:
+            raise error
 
     def process_hospital(self, processed_dir, processed_filename, public=True):
 
@@ -155,7 +506,7 @@ class Ingester(object):
         # set the new file name using the original file name in the layers conf
         supplies_filename = self.agol.layers['supplies']['original_file_name']
 
-        df = load_csv_to_df(os.path.join(processed_dir, processed_filename))
+        df = load_processed_df(processed_dir, processed_filename)
 
         # clumsy check for field names
         missing_headers = list()
@@ -269,7 +620,7 @@ class Ingester(object):
 
         new_data_filename = "new_county_summary_table.csv"
 
-        df = load_csv_to_df(os.path.join(processed_dir, processed_filename))
+        df = load_processed_df(processed_dir, processed_filename)
         d2 = df.groupby(["HospitalCounty"])[hm.county_sum_columns].sum().reset_index()
 
         for new_col_name, num_denom in hm.summary_table_header.items():
@@ -305,16 +656,23 @@ class Ingester(object):
 
         summary_filename = self.agol.layers['summary_table']['original_file_name']
 
-        summary_df = pd.DataFrame()
+        # only the summed columns are read, and only their sums are kept per
+        # file; the table itself is built in one go at the end
+        summary_columns = get_summary_columns()
+        file_sums = []
+        processed_at = []
+        summarized_file_details = []
         for f in processed_file_details:
             fname = f["processed_filename"]
             size = os.path.getsize(os.path.join(processed_dir, fname))
             if size > 0:
-                df = load_csv_to_df(os.path.join(processed_dir, fname))
-                table_row = create_summary_table_row(df, f["source_datetime"], f["filename"])
-                summary_df = summary_df.append(table_row, ignore_index=True)
+                df = load_processed_df(processed_dir, fname, columns=summary_columns)
+                file_sums.append(df[summary_columns].sum().tolist())
+                processed_at.append(datetime.utcnow().isoformat())
+                summarized_file_details.append(f)
             else:
                 print(f"{fname} has a filesize of {size}, not processing.")
+        summary_df = create_summary_table(file_sums, summarized_file_details, processed_at)
 
         if make_historical_csv:
             out_csv_file = os.path.join(processed_dir, summary_filename)
@@ -328,19 +686,18 @@ class Ingester(object):
         table = self.agol.gis.content.get(layer_conf['id'])
         t = table.tables[0]
 
-        new_col_names = {}
-        for name in t.properties.fields:
-            new_col_names[name["alias"]] = name["name"]
-        summary_df = summary_df.rename(columns=new_col_names)
-        df_as_dict = summary_df.to_dict(orient='records')
+        # the summary columns are named by the field aliases; the schema maps
+        # them to the field names and converts numpy values and NaN
+        schema = FeatureSchema(t.properties.fields)
+        df_as_dict = schema.serialize_batch(summary_df.to_dict(orient='records'))
 
         features = []
         for r in df_as_dict:
-            ft = Feature(attributes=r)
+            ft = arcgis_features.Feature(attributes=r)
             features.append(ft)
         # It's okay if features is empty; status will reflect arcgis telling us that,
         # but it won't stop the processing.
-        fs = FeatureSet(features)
+        fs = arcgis_features.FeatureSet(features)
         if self.dry_run:
             if self.verbose:
                 print("Dry run set, not editing features.")
@@ -348,11 +705,20 @@ class Ingester(object):
             status = t.edit_features(adds=features)
             if self.verbose:
                 print(status)
+            # one summary row per file, in the same order the features were added
+            published = [f for f, result in zip(summarized_file_details, status.get("addResults", []))
+                         if result["success"]]
+            self._mark_published("summary_table", published)
         if self.verbose:
             print("Finished load of summary table")
 
 
-    def process_historical_hos(self, processed_dir, processed_file_details,  make_historical_csv=False):
+    def process_historical_hos(self, processed_dir, processed_file_details,  make_historical_csv=False,
+                               upload_concurrency=4, bulk_append_threshold=50000):
+        """Adds the rows of the processed files to the historical table. Up to
+        bulk_append_threshold rows go through edit_features; more than that
+        are staged as one CSV and loaded with a single server-side append.
+        Pass bulk_append_threshold=None to always use edit_features."""
 
         if self.verbose:
             print("Starting load of historical HOS table...")
@@ -363,64 +729,176 @@ class Ingester(object):
         table = self.agol.gis.content.get(layer_conf['id'])
         t = table.layers[0]
 
-        # iterate all csvs and collect the information from each one.
-        # normalize header names at the same time
-        hist_csv_rows = []
-        for f in processed_file_details:
-            fname = f["processed_filename"]
-            print(f"    working on {fname}..")
-            size = os.path.getsize(os.path.join(processed_dir, fname))
-            if size > 0:
-                processed_time = datetime.utcnow().isoformat()
-                with open(os.path.join(processed_dir, fname), newline='') as csvfile:
-                    reader = csv.DictReader(csvfile)
-                    for row in reader:
-
-                        row["Source_Data_Timestamp"] = f["source_datetime"].isoformat()
-                        row["Processed_At"] = processed_time
-                        row["Source_Filename"] = f["filename"]
-                        hist_csv_rows.append(row)
+        schema = FeatureSchema(t.properties.fields)
 
-            else:
-                print(f"{fname} has a filesize of {size}, not processing.")
+        bulk = False
+        if not self.dry_run and bulk_append_threshold is not None:
+            num_rows_estimate = count_processed_rows(processed_dir, processed_file_details)
+            bulk = num_rows_estimate > bulk_append_threshold
+            if self.verbose and bulk:
+                print(f"About {num_rows_estimate} rows to add, loading them with a bulk append.")
 
-        # historical for generating a new source CSV
-        if make_historical_csv and len(hist_csv_rows) > 0:
-            agol_fieldnames = [n["name"] for n in t.properties.fields]
-            headers = set(agol_fieldnames + list(hist_csv_rows[0].keys()))
-            with open(os.path.join(processed_dir, original_data_file_name), "w", newline="") as csvfile:
-                writer = csv.DictWriter(csvfile, fieldnames=headers)
-                writer.writeheader()
-                writer.writerows(hist_csv_rows)
-
-        # It's okay if features is empty; status will reflect arcgis telling us that,
-        # but it won't stop the processing.
-        features = [Feature(attributes=row) for row in hist_csv_rows]
+        # rows are read, written to the historical CSV and uploaded (or
+        # staged for the append) as they go, so only the batches waiting to
+        # be uploaded are held in memory
+        uploader = None
+        staging_path = None
         if self.dry_run:
             if self.verbose:
                 print("Dry run set, not editing features.")
+        elif bulk:
+            fd, staging_path = tempfile.mkstemp(prefix="historical_append_", suffix=".csv", dir=processed_dir)
+            os.close(fd)
         else:
-            fc = len(features)
-            chunksize = 1000
-            feature_batchs = chunks(features, chunksize)
-            fb_list = list(feature_batchs)
-            fbc = len(fb_list)
+            uploader = FeatureUploader(t, max_concurrency=upload_concurrency, schema=schema, verbose=self.verbose)
+
+        num_rows = 0
+        # rows read per historical_row_key(), to tell after an error which
+        # rows are in the table
+        rows_per_key = {}
+        try:
+            with ExitStack() as stack:
+                writer = None
+                staging_writer = None
+                if staging_path is not None:
+                    staging_writer = csv.DictWriter(stack.enter_context(open(staging_path, "w", newline="")),
+                                                    fieldnames=self.agol.get_loadable_fields(t),
+                                                    restval="", extrasaction="ignore")
+                    staging_writer.writeheader()
+                # staged rows go through the schema, as uploaded ones do, a
+                # batch at a time
+                staging_rows = []
+                try:
+                    for row in iter_historical_rows(processed_dir, processed_file_details):
+                        # historical for generating a new source CSV
+                        if make_historical_csv:
+                            if writer is None:
+                                agol_fieldnames = [n["name"] for n in t.properties.fields]
+                                headers = set(agol_fieldnames + list(row.keys()))
+                                csvfile = stack.enter_context(
+                                    open(os.path.join(processed_dir, original_data_file_name), "w", newline=""))
+                                writer = csv.DictWriter(csvfile, fieldnames=headers)
+                                writer.writeheader()
+                            writer.writerow(row)
+                        if uploader is not None:
+                            uploader.add(row)
+                        if staging_writer is not None:
+                            staging_rows.append(row)
+                            if len(staging_rows) >= 1000:
+                                staging_writer.writerows(schema.serialize_csv_batch(staging_rows))
+                                staging_rows = []
+                        num_rows += 1
+                        key = historical_row_key(row, schema)
+                        rows_per_key[key] = rows_per_key.get(key, 0) + 1
+                    if len(staging_rows) > 0:
+                        staging_writer.writerows(schema.serialize_csv_batch(staging_rows))
+                except BaseException:
+                    if uploader is not None:
+                        uploader.abort()
+                    raise
+
+            if staging_path is not None:
+                try:
+                    uploader = self._append_historical_rows(t, schema, staging_path, upload_concurrency)
+                except AppendOutcomeUnknown:
+                    # the append is rolled back if it fails, so each file is
+                    # in the table either whole or not at all; only the ones
+                    # that are count as published, the rest are loaded again
+                    in_table = set(self.agol.get_already_processed_files("full_historical_table"))
+                    landed = [f for f in processed_file_details if f["filename"] in in_table]
+                    print(f"{len(landed)} of {len(processed_file_details)} files are in the historical table; "
+                          f"the others will be loaded again on the next run")
+                    self._mark_published("full_historical_table", landed)
+                    raise
+        finally:
+            if staging_path is not None and os.path.exists(staging_path):
+                os.remove(staging_path)
+
+        # It's okay if nothing was added; status will reflect arcgis telling
+        # us that, but it won't stop the processing.
+        if uploader is not None:
+            try:
+                failed_rows = uploader.close()
+            except Exception:
+                self._record_interrupted_upload(uploader, processed_file_details, rows_per_key)
+                raise
             if self.verbose:
-                print(f"Adding {fc} features to the historical table in {fbc} batches.")
-            for batch in fb_list:
-                status = t.edit_features(adds=batch)
-                b_len = len(batch)
-                num_success = len([x["success"] for x in status["addResults"] if x["success"] == True])
-                fails = b_len - num_success
-                if fails != 0:
-                    print(f"Not all updates succeeded; {fails} failures")
-                    print("XXX do something about this failure!")
-                else:
-                    print(f"All {num_success} features successfull updated in this batch.")
+                print(f"Added {uploader.num_added} of {num_rows} features to the historical table in "
+                      f"{uploader.num_batches} batches ({uploader.num_retried} retried).")
+            # the rest of each file is in the table now; the rows that failed
+            # go in the ledger, and their files only count as fully processed
+            # once a later run has uploaded them
+            if len(failed_rows) > 0:
+                print(f"{len(failed_rows)} features failed to upload, recording them to retry on the next run")
+            self._record_failed_rows("full_historical_table", failed_rows)
+            self._mark_published("full_historical_table", processed_file_details)
+        elif staging_path is not None:
+            self._mark_published("full_historical_table", processed_file_details)
 
         if self.verbose:
             print("Finished load of historical HOS table")
 
+    def _record_interrupted_upload(self, uploader, processed_file_details, rows_per_key):
+        """After an upload to the historical table stopped on an error, puts
+        the rows that weren't added in the failure ledger and marks their
+        files published, for every file that has, or may have, rows in the
+        table, so the next run retries those rows rather than the whole file.
+        The rows of requests that raised go in the ledger as unknown, with
+        the number of rows of their hospital that were added, for the next
+        run to check against the table; the files haven't been published
+        before, so the table held none of their rows. Files none of whose
+        rows were sent are left to be processed again."""
+
+        schema = uploader.schema
+        not_added = uploader.failed_rows + uploader.unsent_rows
+        confirmed = dict(rows_per_key)
+        for row in not_added + uploader.unknown_rows:
+            confirmed[historical_row_key(row, schema)] -= 1
+        started = set(key[0] for key, n in confirmed.items() if n > 0)
+        started |= set(row["Source_Filename"] for row in uploader.unknown_rows)
+
+        rows_to_record = [row for row in not_added if row["Source_Filename"] in started]
+        print(f"Upload to the historical table stopped after adding {uploader.num_added} features; recording "
+              f"{len(rows_to_record)} features that weren't added and {len(uploader.unknown_rows)} that may not "
+              f"have been, from {len(started)} partly uploaded files, to retry on the next run")
+        self._record_failed_rows("full_historical_table", rows_to_record, unknown_rows=uploader.unknown_rows,
+                                 expected_counts=confirmed, schema=schema)
+        self._mark_published("full_historical_table",
+                             [f for f in processed_file_details if f["filename"] in started])
+
+    def _append_historical_rows(self, t, schema, staging_path, upload_concurrency):
+        """Loads the staged rows with one append. If the append is known to
+        have added nothing, the rows are sent through edit_features instead
+        and the uploader doing that is returned, still to be closed. If it
+        isn't known whether the append was applied, the error is raised
+        rather than risk adding every row twice."""
+
+        # the staged columns are named by the fields
+        master_lookup = hm.HeaderMapping("HOS").get_master_lookup()
+        latitude_field, coerce = schema.get_field(master_lookup["HospitalLatitude"])
+        longitude_field, coerce = schema.get_field(master_lookup["HospitalLongitude"])
+        try:
+            result = self.agol.append_csv(t, staging_path, latitude_field=latitude_field,
+                                          longitude_field=longitude_field)
+            if result is True:
+                return None
+            print(f"Bulk append didn't succeed ({result}), adding the rows with edit_features instead")
+        except AppendOutcomeUnknown as e:
+            print(f"Bulk append may or may not have been applied ({e})")
+            raise
+        except Exception as e:
+            print(f"Bulk append failed ({e}), adding the rows with edit_features instead")
+
+        uploader = FeatureUploader(t, max_concurrency=upload_concurrency, schema=schema, verbose=self.verbose)
+        try:
+            with open(staging_path, newline='') as csvfile:
+                for row in csv.DictReader(csvfile):
+                    uploader.add(row)
+        except BaseException:
+            uploader.abort()
+            raise
+        return uploader
+
     def process_daily_hospital_averages(self, historical_gis_item_id, daily_averages_item_id):
         # see what days have been processed
         # if not processed,
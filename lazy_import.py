@@ -0,0 +1,48 @@
+import time
+import importlib
+import threading
+
+# seconds it took to import each lazy module, in the order they were loaded
+import_times = {}
+
+import_lock = threading.Lock()
+
+
+class LazyModule(object):
+    """Stands in for a module until one of its attributes is first used, and
+    only then imports it. Lets the Cloud Function entry points skip loading
+    pandas, pysftp and arcgis on runs that never touch them."""
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        module = self.__dict__["_module"]
+        if module is not None:
+            return module
+
+        with import_lock:
+            module = self.__dict__["_module"]
+            if module is None:
+                start = time.perf_counter()
+                module = importlib.import_module(self._name)
+                import_times[self._name] = time.perf_counter() - start
+                self.__dict__["_module"] = module
+        return module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __repr__(self):
+        state = "loaded" if self.__dict__["_module"] is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    """e.g. pd = lazy_import("pandas")"""
+
+    return LazyModule(name)
@@ -4,13 +4,20 @@ import argparse
 from datetime import datetime
 
 from header_mapping import HeaderMapping
-from operators import process_csv
+from operators import process_csv, process_csv_outputs, open_csv_file
+from operators.processed_cache import ProcessedCache
+from operators.header_registry import HeaderRegistry
 from agol_connection import AGOLConnection
 from validator import CSVValidator
 from ingester import Ingester
+from stage_graph import StageGraph
+import lazy_import
 
 
-def process_instantaneous(dry_run=False, datadir=None, verbose=False):
+def process_instantaneous(dry_run=False, datadir=None, verbose=False, stream=False, publish_concurrency=5):
+    """With stream=True the latest HOS file is read straight from the SFTP
+    server instead of being downloaded to datadir first; only the processed
+    outputs that get published are written."""
 
     hm_hos = HeaderMapping("HOS")
 
@@ -20,103 +27,111 @@ def process_instantaneous(dry_run=False, datadir=None, verbose=False):
     if datadir is None:
         datadir = "/tmp"
 
-    ingester = Ingester(dry_run, verbose=verbose)
-
-    print("Getting latest HOS file from SFTP...")
-    a = datetime.now()
-    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir)
-    print(f"Finished: {datetime.now() - a}")
-
-    latest_file_details = file_details[0]
-
-    # run a validation on the latest file (the one that will be used for instantaneous)
-    a = datetime.now()
-    v = CSVValidator("HOS")
-    fpath = os.path.join(latest_file_details['dir'], latest_file_details['filename'])
-    v.validate_csv(fpath)
-    print(f"latest CSV validated: {datetime.now() - a}")
-
-    # Public-only data
-    a = datetime.now()
-    public_processed_file_details = process_csv(
-        [latest_file_details],
-        output_prefix="public_processed_HOS_",
-        columns_wanted=hm_hos.get_public_column_names(),
-        output_dir=datadir,
-    )
-    public_processed_filename = public_processed_file_details[0]["processed_filename"]
-    public_processed_dir = public_processed_file_details[0]["output_dir"]
-    print(f"processed latest CSV (only public columns): {datetime.now() - a}")
-
-    # Full data
-    a = datetime.now()
-    processed_file_details = process_csv(
-        [latest_file_details],
-        output_dir=datadir
-    )
-    print(f"processed latest CSV (full): {datetime.now() - a}")
-
-    processed_filename = processed_file_details[0]["processed_filename"]
-    processed_dir = processed_file_details[0]["output_dir"]
-
-    print(f"Finished processing {datadir}/{latest_file_details['filename']}, file is {processed_dir}/{processed_filename}")
+    ingester = Ingester(dry_run, verbose=verbose, datadir=datadir)
 
+    if stream:
+        print("Getting latest HOS file details from SFTP...")
+        open_source = ingester.open_sftp_file
+    else:
+        print("Getting latest HOS file from SFTP...")
+        open_source = open_csv_file
+
+    def fetch():
+        file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, download=not stream)
+        return file_details[0]
+
+    # Full and public-only data from a single read of the latest file, which
+    # is validated during the same read
+    def process(latest_file_details):
+        outputs = {
+            # supplies and county summaries read the full output through pandas
+            "full": {"output_prefix": "processed_HOS_", "columns_wanted": [], "columnar": True},
+            "public": {"output_prefix": "public_processed_HOS_", "columns_wanted": hm_hos.get_public_column_set()},
+        }
+        try:
+            processed_outputs = process_csv_outputs(
+                [latest_file_details],
+                outputs,
+                output_dir=datadir,
+                open_source=open_source,
+                validator=CSVValidator("HOS"),
+                header_registry=HeaderRegistry(datadir),
+            )
+        finally:
+            ingester.close_sftp()
+        full = processed_outputs["full"][0]
+        print(f"Finished processing {datadir}/{latest_file_details['filename']}, "
+              f"file is {full['output_dir']}/{full['processed_filename']}")
+        return {name: (details[0]["output_dir"], details[0]["processed_filename"])
+                for name, details in processed_outputs.items()}
+
+    # every upload needs only the processed file, and the DHS summaries not
+    # even that, so each starts as soon as it can
+    graph = StageGraph(max_workers=publish_concurrency)
+    graph.add("fetch latest HOS file", fetch)
+    graph.add("validate and process latest CSV (full and public columns)", process,
+              requires=["fetch latest HOS file"])
+    processed = ["validate and process latest CSV (full and public columns)"]
     # process csv to update the non-public hospital table
-    a = datetime.now()
-    ingester.process_hospital(processed_dir, processed_filename, public=False)
-    print(f"process hospital (full): {datetime.now() - a}")
-
+    graph.add("process hospital (full)",
+              lambda p: ingester.process_hospital(*p["full"], public=False), requires=processed)
     # process csv to update the public hospital table
-    a = datetime.now()
-    ingester.process_hospital(public_processed_dir, public_processed_filename)
-    print(f"process hospital (public): {datetime.now() - a}")
-
-    # process supplies
-    a = datetime.now()
-    ingester.process_supplies(processed_dir, processed_filename)
-    print(f"process supplies: {datetime.now() - a}")
-
-    # process DHS feeding needs county summaries
-    a = datetime.now()
-    ingester.process_DHS_feeding_needs_county_summaries(datadir)
-    print(f"process DHS feeding needs county summaries: {datetime.now() - a}")
-
+    graph.add("process hospital (public)",
+              lambda p: ingester.process_hospital(*p["public"]), requires=processed)
+    graph.add("process supplies",
+              lambda p: ingester.process_supplies(*p["full"]), requires=processed)
+    graph.add("process DHS feeding needs county summaries",
+              lambda: ingester.process_DHS_feeding_needs_county_summaries(datadir))
     # process county-level summary
-    a = datetime.now()
-    ingester.process_county_summaries(processed_dir, processed_filename)
-    print(f"process county summaries: {datetime.now() - a}")
+    graph.add("process county summaries",
+              lambda p: ingester.process_county_summaries(*p["full"]), requires=processed)
+    graph.run()
+
     print(f"FINISHED process_instantaneous(): {datetime.now() - start}")
 
-def process_historical(dry_run=False, datadir=None, make_historical_csv=False, verbose=False):
+def process_historical(dry_run=False, datadir=None, make_historical_csv=False, verbose=False, sftp_connections=1,
+                       processes=1, upload_concurrency=4, bulk_append_threshold=50000):
 
     print("\nSTARTING process_historical()")
     start = datetime.now()
     if datadir is None:
         datadir = "/tmp"
 
-    ingester = Ingester(dry_run, verbose=verbose)
+    ingester = Ingester(dry_run, verbose=verbose, datadir=datadir)
+    # both tables below are built from the same processed files
+    processed_cache = ProcessedCache(os.path.join(datadir, "processed_cache"))
+    header_registry = HeaderRegistry(datadir)
 
     a = datetime.now()
     files_to_not_sftp = ingester.get_already_processed_files("summary_table")
     print(f"determined already processed files (summary_table): {datetime.now() - a}")
 
     a = datetime.now()
-    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False, filenames_to_ignore=files_to_not_sftp)
+    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False, filenames_to_ignore=files_to_not_sftp,
+                                                               connections=sftp_connections)
     print(f"downloaded files: {datetime.now() - a}")
 
     if len(file_details) == 0:
         print("  No new files to process for historical summary table data.")
     else:
         a = datetime.now()
-        processed_file_details = process_csv(file_details, output_dir=datadir)
+        processed_file_details = process_csv(file_details, output_dir=datadir, workers=processes, cache=processed_cache,
+                                             columnar=True, header_registry=header_registry)
         print(f"process_csv(): {datetime.now() - a}")
         processed_dir = processed_file_details[0]["output_dir"]
         a = datetime.now()
         ingester.process_summaries(processed_dir, processed_file_details, make_historical_csv=make_historical_csv)
         print(f"process_summaries(): {datetime.now() - a}")
 
+    # rows that failed to upload in earlier runs, before anything new
+    a = datetime.now()
+    ingester.retry_failed_historical_rows(upload_concurrency=upload_concurrency)
+    print(f"retried failed historical rows: {datetime.now() - a}")
+
     a = datetime.now()
-    files_to_not_sftp = ingester.get_already_processed_files("full_historical_table")
+    # files with rows left in the failure ledger are only retried row by row
+    # above, never uploaded again in full
+    files_to_not_sftp = ingester.get_already_processed_files("full_historical_table", include_failed=True)
     print(f"determined already processed files (full_historical_table): {datetime.now() - a}")
 
     if make_historical_csv:
@@ -124,7 +139,8 @@ def process_historical(dry_run=False, datadir=None, make_historical_csv=False, v
         files_to_not_sftp = []
 
     a = datetime.now()
-    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False, filenames_to_ignore=files_to_not_sftp)
+    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False, filenames_to_ignore=files_to_not_sftp,
+                                                               connections=sftp_connections)
     print(f"downloaded files: {datetime.now() - a}")
 
     if len(file_details) == 0:
@@ -133,11 +149,14 @@ def process_historical(dry_run=False, datadir=None, make_historical_csv=False, v
         lf = len(file_details)
         print(f"  {lf} new files to process for historical data.")
         a = datetime.now()
-        processed_file_details = process_csv(file_details, output_dir=datadir)
+        processed_file_details = process_csv(file_details, output_dir=datadir, workers=processes, cache=processed_cache,
+                                             header_registry=header_registry)
         print(f"process_csv(): {datetime.now() - a}")
         processed_dir = processed_file_details[0]["output_dir"]
         a = datetime.now()
-        ingester.process_historical_hos(processed_dir, processed_file_details, make_historical_csv=make_historical_csv)
+        ingester.process_historical_hos(processed_dir, processed_file_details, make_historical_csv=make_historical_csv,
+                                        upload_concurrency=upload_concurrency,
+                                        bulk_append_threshold=bulk_append_threshold)
         print(f"process_historical_hos: {datetime.now() - a}")
 
     print(f"FINISHED process_historical(): {datetime.now()-start}")
@@ -156,14 +175,22 @@ def process_canary_features(dry_run=False, datadir=None, verbose=False):
     ingester.process_daily_hospital_averages(historical_gis_item_id, historical_averages_item_id)
     print("Finished canary features.")
 
-def main(dry_run, datadir=None, make_historical_csv=False, verbose=False):
+def main(dry_run, datadir=None, make_historical_csv=False, verbose=False, sftp_connections=1, stream=False,
+         processes=1, upload_concurrency=4, bulk_append_threshold=50000, publish_concurrency=5):
     #process_canary_features(dry_run=dry_run, datadir=datadir, verbose=verbose)
-    process_instantaneous(dry_run=dry_run, datadir=datadir, verbose=verbose)
-    process_historical(dry_run=dry_run, datadir=datadir, make_historical_csv=make_historical_csv, verbose=verbose)
+    process_instantaneous(dry_run=dry_run, datadir=datadir, verbose=verbose, stream=stream,
+                          publish_concurrency=publish_concurrency)
+    process_historical(dry_run=dry_run, datadir=datadir, make_historical_csv=make_historical_csv, verbose=verbose,
+                       sftp_connections=sftp_connections, processes=processes, upload_concurrency=upload_concurrency,
+                       bulk_append_threshold=bulk_append_threshold)
+    if verbose:
+        for name, seconds in lazy_import.import_times.items():
+            print(f"imported {name} on first use in {seconds:.2f}s")
 
 def instantaneous_pubsub(event, context):
     print("Started instantaneous ingestion processing run")
-    process_instantaneous()
+    # /tmp is memory-backed on Cloud Functions, so don't land the raw file there
+    process_instantaneous(stream=True)
     print("Finished instantaneous ingestion processing run")
 
 def historical_pubsub(event, context):
@@ -179,10 +206,25 @@ if __name__== "__main__":
     parser.add_argument("--dir")
     parser.add_argument("--make_historical_csv", action="store_true")
     parser.add_argument("--quiet", action="store_true")
+    parser.add_argument("--sftp_connections", type=int, default=1,
+                        help="number of concurrent SFTP sessions used to download historical files")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the latest HOS file straight from SFTP instead of downloading it first")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="number of processes used to process historical files")
+    parser.add_argument("--upload_concurrency", type=int, default=4,
+                        help="number of edit_features requests in flight when uploading the historical table")
+    parser.add_argument("--bulk_append_threshold", type=int, default=50000,
+                        help="load the historical table with one server-side append above this many new rows")
+    parser.add_argument("--publish_concurrency", type=int, default=5,
+                        help="number of instantaneous stages (downloads, processing, uploads) run at once")
     args = parser.parse_args()
 
     print(f"dry_run: {args.dry_run}")
 
     # note that the cli argument is --quiet but from here on the argument passed around is "verbose"
     verbose = not args.quiet
-    main(args.dry_run, datadir=args.dir, make_historical_csv=args.make_historical_csv, verbose=verbose)
+    main(args.dry_run, datadir=args.dir, make_historical_csv=args.make_historical_csv, verbose=verbose,
+         sftp_connections=args.sftp_connections, stream=args.stream, processes=args.processes,
+         upload_concurrency=args.upload_concurrency, bulk_append_threshold=args.bulk_append_threshold,
+         publish_concurrency=args.publish_concurrency)
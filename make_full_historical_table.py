@@ -15,8 +15,8 @@ if __name__ == "__main__":
 
     datadir = "data"
 
-    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False)
+    file_details, all_filenames = ingester.get_files_from_sftp(target_dir=datadir, only_latest=False, connections=8)
 
-    processed_file_details = process_csv(file_details, output_dir=datadir, overwrite=False)
+    processed_file_details = process_csv(file_details, output_dir=datadir, overwrite=False, workers=os.cpu_count())
 
     ingester.process_historical_hos(datadir, processed_file_details, make_historical_csv=True)
@@ -1,2 +1,7 @@
 from .process_csv import process_csv
+from .process_csv import process_csv_outputs
 from .utils import get_datetime_from_filename
+from .utils import open_csv_file
+from .utils import hash_file
+from .utils import atomic_write
+from .facility_index import load_facility_index
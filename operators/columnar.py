@@ -0,0 +1,36 @@
+import os
+from lazy_import import lazy_import
+from operators.utils import atomic_write
+
+pd = lazy_import("pandas")
+
+
+def get_columnar_path(csv_path):
+    """The columnar intermediate sits next to the processed CSV it mirrors."""
+
+    return os.path.splitext(csv_path)[0] + ".parquet"
+
+
+def write_columnar(path, header, columns):
+    """Writes parallel header/column value lists as a typed Parquet file.
+    Columns whose values are all numeric (ignoring blanks) are stored as
+    numbers, everything else as strings; blanks become nulls. This is the
+    dtype guessing pd.read_csv would otherwise do in every consumer, done once
+    when the file is produced."""
+
+    data = {}
+    for name, values in zip(header, columns):
+        series = pd.Series([None if v == "" else v for v in values], dtype=object)
+        try:
+            series = pd.to_numeric(series)
+        except (ValueError, TypeError):
+            pass
+        data[name] = series
+    df = pd.DataFrame(data, columns=header)
+
+    with atomic_write(path) as tmp_path:
+        df.to_parquet(tmp_path, index=False)
+
+
+def read_columnar(path, columns=None):
+    return pd.read_parquet(path, columns=columns)
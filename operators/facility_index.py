@@ -0,0 +1,181 @@
+import os
+import mmap
+import json
+import array
+import struct
+import tempfile
+
+from operators.utils import load_geojson, hash_file, atomic_write
+
+MAGIC = b"FACIDX01"
+# bump this whenever the layout below changes
+INDEX_VERSION = 1
+
+
+class FacilityIndex(object):
+    """Facility names, aliases and coordinates compiled from a HOS or LTC
+    geojson. Looking up a name or alias gives the facility it belongs to.
+    Coordinates stay in the memory-mapped index file; only the interned name
+    table and the name lookup are built in memory.
+
+    Layout, after MAGIC and a length-prefixed JSON header:
+      float64[2 * n]   long, lat per facility
+      uint32[n]        string table index of each facility's name
+      uint32[k]        string table index of each lookup key (names and aliases)
+      uint32[k]        facility of each lookup key
+      utf-8 strings, NUL separated
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        buf = memoryview(self.mm)
+        offset = len(MAGIC)
+        meta_len = struct.unpack_from("<I", buf, offset)[0]
+        offset += 4
+        self.meta = json.loads(bytes(buf[offset:offset + meta_len]).decode("utf8"))
+        offset += meta_len
+        offset = _align(offset)
+
+        n = self.meta["num_facilities"]
+        k = self.meta["num_keys"]
+        self.coords = buf[offset:offset + 16 * n].cast("d")
+        offset += 16 * n
+        name_ids = buf[offset:offset + 4 * n].cast("I")
+        offset += 4 * n
+        key_ids = buf[offset:offset + 4 * k].cast("I")
+        offset += 4 * k
+        key_facilities = buf[offset:offset + 4 * k].cast("I")
+        offset += 4 * k
+        strings = bytes(buf[offset:]).decode("utf8").split("\0")
+
+        self.names = [strings[i] for i in name_ids]
+        self.lookup = dict(zip((strings[i] for i in key_ids), key_facilities))
+
+    def __reduce__(self):
+        # the mapping can't be pickled, so worker processes reopen the file
+        return (FacilityIndex, (self.path,))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.lookup
+
+    def get(self, name):
+        """Returns {"name", "long", "lat"} for the facility that name is the
+        name or an alias of, or None."""
+
+        i = self.lookup.get(name)
+        if i is None:
+            return None
+        return {"name": self.names[i], "long": self.coords[2 * i], "lat": self.coords[2 * i + 1]}
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def build_facility_index(geojson_path, index_path, idfield, alias_field):
+    """Compiles geojson_path into index_path. Keys are stripped names and
+    aliases; a facility's own name wins over another facility's alias."""
+
+    facilities = load_geojson(geojson_path, idfield)
+
+    strings = {}
+    def intern(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    coords = array.array("d")
+    name_ids = array.array("I")
+    keys = {}
+    for i, (name, props) in enumerate(facilities.items()):
+        coords.append(float(props["long"]))
+        coords.append(float(props["lat"]))
+        name_ids.append(intern(name))
+        aliases = props.get(alias_field)
+        if aliases is None:
+            continue
+        for alias in aliases.split("|"):
+            keys.setdefault(alias.strip(), i)
+    for i, name in enumerate(facilities.keys()):
+        keys[name.strip()] = i
+
+    key_ids = array.array("I", [intern(key) for key in keys])
+    key_facilities = array.array("I", keys.values())
+    for a in (coords, name_ids, key_ids, key_facilities):
+        if a.itemsize != {"d": 8, "I": 4}[a.typecode]:
+            raise RuntimeError("unsupported platform for the facility index")
+
+    st = os.stat(geojson_path)
+    meta = {
+        "version": INDEX_VERSION,
+        "source_size": st.st_size,
+        "source_mtime_ns": st.st_mtime_ns,
+        "source_sha256": hash_file(geojson_path),
+        "idfield": idfield,
+        "alias_field": alias_field,
+        "num_facilities": len(name_ids),
+        "num_keys": len(key_ids),
+    }
+    meta_bytes = json.dumps(meta).encode("utf8")
+
+    header = MAGIC + struct.pack("<I", len(meta_bytes)) + meta_bytes
+    header += b"\0" * (_align(len(header)) - len(header))
+    string_table = "\0".join(strings.keys()).encode("utf8")
+
+    with atomic_write(index_path) as tmp_path:
+        with open(tmp_path, "wb") as f:
+            f.write(header)
+            f.write(coords.tobytes())
+            f.write(name_ids.tobytes())
+            f.write(key_ids.tobytes())
+            f.write(key_facilities.tobytes())
+            f.write(string_table)
+
+
+def _index_is_current(index_path, geojson_path, idfield, alias_field):
+    try:
+        with open(index_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                return False
+            meta_len = struct.unpack("<I", f.read(4))[0]
+            meta = json.loads(f.read(meta_len).decode("utf8"))
+    except (OSError, ValueError, struct.error):
+        return False
+
+    st = os.stat(geojson_path)
+    return meta.get("version") == INDEX_VERSION and \
+        meta.get("idfield") == idfield and \
+        meta.get("alias_field") == alias_field and \
+        meta.get("source_size") == st.st_size and \
+        meta.get("source_mtime_ns") == st.st_mtime_ns
+
+
+def load_facility_index(geojson_path, idfield, alias_field, index_dir=None):
+    """Returns the FacilityIndex for geojson_path, compiling it first if there
+    is no index yet or the geojson has changed since it was built. The index
+    lives next to the geojson, or in the temp dir if that isn't writable (as
+    on Cloud Functions), unless index_dir is given."""
+
+    index_name = "." + os.path.basename(geojson_path) + ".idx"
+    if index_dir is not None:
+        candidates = [index_dir]
+    else:
+        candidates = [os.path.dirname(os.path.abspath(geojson_path)), tempfile.gettempdir()]
+
+    for directory in candidates:
+        index_path = os.path.join(directory, index_name)
+        if _index_is_current(index_path, geojson_path, idfield, alias_field):
+            return FacilityIndex(index_path)
+        try:
+            build_facility_index(geojson_path, index_path, idfield, alias_field)
+        except OSError:
+            continue
+        return FacilityIndex(index_path)
+
+    raise OSError(f"could not write a facility index for {geojson_path} to any of {candidates}")
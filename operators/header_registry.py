@@ -0,0 +1,94 @@
+import os
+import json
+import hashlib
+
+from header_mapping import HeaderMapping
+from operators.utils import atomic_write
+
+
+class HeaderRegistry(object):
+    """Header layouts seen in HOS files, kept in a JSON file in the data dir
+    across runs. Each distinct header row is stored under a fingerprint with
+    its resolved mapping (the normalized columns and the source position of
+    each) and its unmapped fields, so files with a known layout skip
+    resolving the mapping, and a new layout is reported once, when it is
+    first seen. Changing the header mapping starts the registry over."""
+
+    def __init__(self, datadir, filename="header_registry.json"):
+        self.path = os.path.join(datadir, filename)
+        self.mapping_version = HeaderMapping("HOS").get_version()
+        self.layouts = {}
+        # layouts added since the registry was loaded or last handed over
+        self.new_layouts = {}
+        self.dirty = False
+        # worker processes leave reporting to the parent, which merges what
+        # they found
+        self.report_new = True
+
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if data.get("mapping_version") == self.mapping_version:
+                self.layouts = data["layouts"]
+
+    def get_fingerprint(self, headers):
+        h = hashlib.sha256()
+        h.update(self.mapping_version.encode("utf8"))
+        h.update(json.dumps(list(headers)).encode("utf8"))
+        return h.hexdigest()
+
+    def get(self, headers):
+        """Returns the resolved mapping stored for this header row, or None
+        if the layout hasn't been seen."""
+
+        return self.layouts.get(self.get_fingerprint(headers))
+
+    def add(self, headers, resolution, source_filename=None):
+        """Stores the resolved mapping for a header row, reporting the layout
+        if it is new."""
+
+        fingerprint = self.get_fingerprint(headers)
+        if fingerprint in self.layouts:
+            return
+        entry = dict(resolution)
+        entry["headers"] = list(headers)
+        entry["first_seen"] = source_filename
+        self._add_entry(fingerprint, entry)
+
+    def _add_entry(self, fingerprint, entry):
+        self.layouts[fingerprint] = entry
+        self.new_layouts[fingerprint] = entry
+        self.dirty = True
+        if not self.report_new:
+            return
+
+        print(f"new header layout {fingerprint[:12]} (first seen in {entry['first_seen']}): "
+              f"{len(entry['columns'])} mapped column(s)")
+        if len(entry["unmapped_fields"]) > 0:
+            print(f"{len(entry['unmapped_fields'])} unmapped field(s) will be ignored:")
+            print("|".join(entry["unmapped_fields"]))
+
+    def take_new_layouts(self):
+        """Returns the layouts added since the last call, e.g. to hand them
+        from a worker process's copy of the registry to the parent's."""
+
+        new_layouts = self.new_layouts
+        self.new_layouts = {}
+        return new_layouts
+
+    def merge(self, layouts):
+        """Adds layouts from take_new_layouts() on another copy of the
+        registry."""
+
+        for fingerprint, entry in layouts.items():
+            if fingerprint not in self.layouts:
+                self._add_entry(fingerprint, entry)
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {"mapping_version": self.mapping_version, "layouts": self.layouts}
+        with atomic_write(self.path) as tmp_path:
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps(data, indent=2))
+        self.dirty = False
@@ -1,7 +1,12 @@
 import os
 import csv
-from geo_utils import HospitalLocations
+import tempfile
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from geo_utils import get_hospital_resolver
 import header_mapping
+from operators.utils import open_csv_file, hash_file
+from operators.columnar import get_columnar_path, write_columnar
 
 def y_to_one(x):
     if x == "Y":
@@ -42,98 +47,338 @@ converters = {'n95util1528': y_to_one,
  'nputil>=15': y_to_one,
  }
 
-def normalize_row_keys(row, master_lookup):
-    """transforms the input row's headers to the normalized set, based on the
-    input lookup dictionary."""
+class ProjectionPlan(object):
+    """Compiled form of the header mapping for one header layout. Maps source
+    column positions to normalized column positions, with the converter for
+    each, so rows can be processed as plain csv.reader lists instead of being
+    rebuilt as dicts."""
 
-    new_row = {}
+    def __init__(self, headers, resolution, master_lookup):
+        hos_name_key = master_lookup["HospitalName"]
+        hos_lat_key = master_lookup["HospitalLatitude"]
+        hos_long_key = master_lookup["HospitalLongitude"]
+        hos_county_key = "HospitalCounty"
 
-    for k, v in row.items():
-        if k in master_lookup:
-            new_row[master_lookup[k]] = v
+        self.resolution = resolution
+        columns = list(resolution["columns"])
+        source_index = dict(zip(columns, resolution["source_indexes"]))
 
-    return new_row
+        self.unmapped_fields = resolution["unmapped_fields"]
+        self.source_indexes = list(resolution["source_indexes"])
+        self.num_source_columns = len(headers)
+        self.converters = [(pos, converters[k]) for pos, k in enumerate(columns) if k in converters]
+
+        # the location lookup fills these in, adding them if the source lacks them
+        self.county_from_source = hos_county_key in source_index
+        for k in [hos_lat_key, hos_long_key, hos_county_key]:
+            if k not in source_index:
+                columns.append(k)
+        self.columns = columns
+        self.name_pos = columns.index(hos_name_key)
+        self.lat_pos = columns.index(hos_lat_key)
+        self.long_pos = columns.index(hos_long_key)
+        self.county_pos = columns.index(hos_county_key)
+        self.padding = [None] * (len(columns) - len(self.source_indexes))
+
+        # the looked up county is kept just past the end of the normalized
+        # row, for projections that drop the source's own county column
+        self.geocoded_county_pos = len(columns)
+        self.projections = {}
+
+    def normalize(self, row):
+        """Returns the normalized row, before the location lookup, for a row
+        from csv.reader. Missing trailing values are None, as with DictReader."""
+
+        if len(row) < self.num_source_columns:
+            row = row + [None] * (self.num_source_columns - len(row))
+        new_row = [row[i] for i in self.source_indexes]
+        for pos, converter in self.converters:
+            new_row[pos] = converter(new_row[pos])
+        return new_row + self.padding
+
+    def get_projection(self, columns_wanted):
+        """Returns (header, positions) for an output restricted to
+        columns_wanted. The columns filled in from the location lookup are
+        always kept, at the end with the looked up values if the projection
+        would otherwise have dropped them."""
+
+        key = frozenset(columns_wanted)
+        if key in self.projections:
+            return self.projections[key]
+
+        if len(columns_wanted) == 0:
+            positions = list(range(len(self.columns)))
+        else:
+            positions = [pos for pos, k in enumerate(self.columns) if k.strip() in key]
+            for pos in [self.lat_pos, self.long_pos]:
+                if pos not in positions:
+                    positions.append(pos)
+            if self.county_pos not in positions:
+                positions.append(self.geocoded_county_pos)
+
+        header = [self.columns[pos] if pos < len(self.columns) else self.columns[self.county_pos]
+                  for pos in positions]
+        projection = (header, positions)
+        self.projections[key] = projection
+        return projection
+
+
+def resolve_headers(headers, master_lookup):
+    """Resolves a header row against the mapping: the normalized columns, the
+    source position of each and the headers that aren't mapped."""
+
+    # a repeated header takes the value of its last occurrence, as with
+    # DictReader
+    last_index = {h: i for i, h in enumerate(headers)}
+
+    # normalized columns in the order they first appear; when several
+    # source headers map to the same name the last one wins
+    columns = []
+    source_index = {}
+    for h, i in last_index.items():
+        if h in master_lookup:
+            k = master_lookup[h]
+            if k not in source_index:
+                columns.append(k)
+            source_index[k] = i
+
+    return {
+        "columns": columns,
+        "source_indexes": [source_index[k] for k in columns],
+        "unmapped_fields": [h for h in headers if h not in master_lookup],
+    }
+
+
+# plans are shared across files and calls; historical files only come in a
+# handful of header layouts
+projection_plans = {}
+
+def get_projection_plan(headers, master_lookup, header_registry=None, source_filename=None):
+    """header_registry is an optional HeaderRegistry; layouts it knows skip
+    resolve_headers(), and new ones are added to it. Without one, unmapped
+    fields are reported once per layout per process."""
+
+    key = tuple(headers)
+    plan = projection_plans.get(key)
+    resolution = None
+    if header_registry is not None:
+        resolution = header_registry.get(headers)
+        if resolution is None:
+            resolution = plan.resolution if plan is not None else resolve_headers(headers, master_lookup)
+            header_registry.add(headers, resolution, source_filename)
+    if plan is None:
+        if resolution is None:
+            resolution = resolve_headers(headers, master_lookup)
+            if len(resolution["unmapped_fields"]) > 0:
+                print(f"{len(resolution['unmapped_fields'])} unmapped field(s) will be ignored:")
+                print("|".join(resolution["unmapped_fields"]))
+        plan = ProjectionPlan(headers, resolution, master_lookup)
+        projection_plans[key] = plan
+    return plan
 
 # accepts a list of files to get (or latest if no list), prefix, column restrictions
 # returns a list of files
-def process_csv(file_details, output_dir="/tmp", output_prefix="processed_HOS_", columns_wanted=[], overwrite=True):
-    hl = HospitalLocations()
-    HM = header_mapping.HeaderMapping("HOS")
-
-    master_lookup = HM.get_master_lookup()
-
-    output_file_details = []
-    for source_file_details in file_details:
-        source_data_file = source_file_details["filename"]
-        source_data_dir = source_file_details["dir"]
-        output_filename = output_prefix + source_data_file
-
-        source_file_details["processed_filename"] = output_filename
-        source_file_details["output_dir"] = output_dir
-        output_path = os.path.join(output_dir, output_filename)
-
-        if os.path.exists(output_path) and overwrite is False:
-            output_file_details.append(source_file_details)
-            continue
-
-        rows = []
-        with open (os.path.join(source_data_dir, source_data_file), newline='', encoding="utf8") as rf:
-            reader = csv.DictReader(rf)
-            unmapped_fields = [i for i in reader.fieldnames if i not in master_lookup.keys()]
-            if len(unmapped_fields) > 0:
-                print(f"{len(unmapped_fields)} unmapped field(s) will be ignored:")
-                print("|".join(unmapped_fields))
+# open_source is called with the source path and must return a text file object;
+# pass Ingester.open_sftp_file to read straight from the SFTP server.
+# With workers > 1 the files are processed in that many processes, which
+# needs open_source to be picklable (i.e. the default, for local files).
+# cache is an optional ProcessedCache; local files whose output is already in
+# it are not processed again.
+# With columnar=True a typed Parquet copy of each output is written next to
+# it, for the pandas stages to read instead of re-parsing the CSV.
+# validator is an optional CSVValidator run during the same read of each file;
+# its result is added to the file details as "validation". Files that come
+# from the cache, or are skipped because overwrite is False, aren't read and
+# so aren't validated.
+# header_registry is an optional HeaderRegistry that remembers header layouts
+# across runs; it is saved once all files are processed.
+def process_csv(file_details, output_dir="/tmp", output_prefix="processed_HOS_", columns_wanted=[], overwrite=True,
+                open_source=open_csv_file, workers=1, cache=None, columnar=False, validator=None,
+                header_registry=None):
+    outputs = {
+        "processed": {"output_prefix": output_prefix, "columns_wanted": columns_wanted, "columnar": columnar},
+    }
+    return process_csv_outputs(file_details, outputs, output_dir=output_dir, overwrite=overwrite,
+                               open_source=open_source, workers=workers, cache=cache,
+                               validator=validator, header_registry=header_registry)["processed"]
+
+# outputs maps an output name to {"output_prefix": ..., "columns_wanted": [...]},
+# optionally with "columnar": True.
+# Each source file is read, normalized and enriched once, and every row is
+# written to one file per output. Returns a dict of output name to a list of
+# file details, in the same form (and the same order) process_csv() returns.
+def process_csv_outputs(file_details, outputs, output_dir="/tmp", overwrite=True, open_source=open_csv_file,
+                        workers=1, cache=None, validator=None, header_registry=None):
+    if workers > 1 and len(file_details) > 1:
+        args = [(f, outputs, output_dir, overwrite, open_source, cache, validator) for f in file_details]
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(header_registry,)) as executor:
+            # map() yields in submission order, so the output order doesn't
+            # depend on which worker finishes first
+            for result, new_layouts in executor.map(process_file_in_worker, args):
+                results.append(result)
+                if header_registry is not None:
+                    header_registry.merge(new_layouts)
+    else:
+        resolver = get_hospital_resolver()
+        master_lookup = header_mapping.HeaderMapping("HOS").get_master_lookup()
+        results = [process_source_file(f, outputs, output_dir, overwrite, open_source, cache, validator,
+                                       resolver, master_lookup, header_registry)
+                   for f in file_details]
+
+    if cache is not None:
+        cache.evict()
+    if header_registry is not None:
+        header_registry.save()
+
+    output_file_details = {name: [] for name in outputs}
+    for result in results:
+        for name, details in result.items():
+            output_file_details[name].append(details)
+    return output_file_details
+
+# loaded once per worker process by init_worker()
+worker_state = {}
+
+def init_worker(header_registry=None):
+    worker_state["resolver"] = get_hospital_resolver()
+    worker_state["master_lookup"] = header_mapping.HeaderMapping("HOS").get_master_lookup()
+    # each worker gets a copy of the registry; the layouts it adds are handed
+    # back with each result
+    if header_registry is not None:
+        header_registry.report_new = False
+    worker_state["header_registry"] = header_registry
+
+def process_file_in_worker(args):
+    source_file_details, outputs, output_dir, overwrite, open_source, cache, validator = args
+    header_registry = worker_state["header_registry"]
+    result = process_source_file(source_file_details, outputs, output_dir, overwrite, open_source, cache, validator,
+                                 worker_state["resolver"], worker_state["master_lookup"], header_registry)
+    new_layouts = header_registry.take_new_layouts() if header_registry is not None else {}
+    return result, new_layouts
+
+def process_source_file(source_file_details, outputs, output_dir, overwrite, open_source, cache, validator,
+                        resolver, master_lookup, header_registry=None):
+    """Processes one source file into every output, returning a dict of output
+    name to the output file details."""
+
+    source_data_file = source_file_details["filename"]
+    source_data_dir = source_file_details["dir"]
+
+    output_file_details = {}
+    output_paths = {}
+    columnar_paths = {}
+    for name, output in outputs.items():
+        output_filename = output["output_prefix"] + source_data_file
+        details = dict(source_file_details)
+        details["processed_filename"] = output_filename
+        details["output_dir"] = output_dir
+        output_file_details[name] = details
+        output_paths[name] = os.path.join(output_dir, output_filename)
+        if output.get("columnar", False):
+            columnar_paths[name] = get_columnar_path(output_paths[name])
+
+    if overwrite is False and all(os.path.exists(p) for p in list(output_paths.values()) + list(columnar_paths.values())):
+        return output_file_details
+
+    # only local sources can be hashed without reading them an extra time
+    cache_keys = {}
+    if cache is not None and open_source is open_csv_file:
+        source_hash = hash_file(os.path.join(source_data_dir, source_data_file))
+        cache_keys = {name: cache.make_key(source_hash, output["columns_wanted"]) for name, output in outputs.items()}
+        if all(cache.get(cache_keys[name], output_paths[name]) for name in outputs) and \
+                all(cache.get(cache_keys[name], path, ext=".parquet") for name, path in columnar_paths.items()):
+            return output_file_details
+
+    # outputs are written to temporary files as rows are produced and renamed
+    # into place once complete, so an output that shares its inode with a
+    # cache entry is replaced rather than overwritten
+    tmp_paths = {}
+    validation = None
+    with ExitStack() as stack:
+        try:
+            source_path = os.path.join(source_data_dir, source_data_file)
+            rf = stack.enter_context(open_source(source_path))
+            reader = csv.reader(rf)
+            headers = next(reader)
+            if validator is not None:
+                validation = validator.begin(source_path)
+                validation.check_headers(headers)
+            plan = get_projection_plan(headers, master_lookup, header_registry, source_data_file)
+
+            # the output schema is fixed by the projection before any row is read
+            writers = []
+            columnar_outputs = {}
+            for name, output in outputs.items():
+                header, positions = plan.get_projection(output["columns_wanted"])
+                fd, tmp_paths[name] = tempfile.mkstemp(suffix=".part", dir=output_dir)
+                writer = csv.writer(stack.enter_context(open(fd, 'w', newline='')))
+                writer.writerow(header)
+                # the columnar copy has to hold one file's values until it is
+                # written; the CSV does not
+                columns = None
+                if name in columnar_paths:
+                    columns = [[] for pos in positions]
+                    columnar_outputs[name] = (header, columns)
+                writers.append((writer, positions, columns))
 
             for row in reader:
-                new_row = normalize_row_keys(row, master_lookup)
-
-                if len(columns_wanted) > 0:
-                    ks = list(new_row.keys())
-                    for k in ks:
-                        if k.strip() not in columns_wanted:
-                            del new_row[k]
-
-                for k, v in new_row.items():
-                    if k in converters:
-                        new_row[k] = converters[k](v)
-
-                hos_name_key = master_lookup["HospitalName"]
-                hos_lat_key = master_lookup["HospitalLatitude"]
-                hos_long_key = master_lookup["HospitalLongitude"]
-                hos_county_key = "HospitalCounty"
-
-                # Older files have bad names for hospitals.
-                try:
-                    new_row[hos_name_key] = hl.get_canonical_name(new_row[hos_name_key])
-                except TypeError as e:
-                    print(f"{source_data_file}: " + new_row[hos_name_key] + " has no canonical information!")
-                    raise e
-
-                # fix bad lat/longs
-                try:
-                    hos_name = new_row[hos_name_key]
-                    loc = hl.get_location_for_hospital(new_row[hos_name_key])
-                    new_row[hos_lat_key] = loc["HospitalLatitude"]
-                    new_row[hos_long_key] = loc["HospitalLongitude"]
-
-                except TypeError as e:
-                    print(f"{source_data_file}: " + new_row[hos_name_key] + " has no location information!")
-                    raise e
-
-                # Add the county; future proof in case they add it later
-                try:
-                    if hos_county_key not in new_row:
-                        loc = hl.get_location_for_hospital(new_row[hos_name_key])
-                        new_row[hos_county_key] = loc["GeocodedHospitalCounty"]
-                except TypeError as e:
-                    print(f"{source_data_file}: " + new_row[hos_name_key] + " has no location information!")
-                    raise e
-
-
-                rows.append(new_row)
-        with open (output_path, 'w', newline='') as wf:
-            writer = csv.DictWriter(wf, fieldnames=rows[0].keys())
-            writer.writeheader()
-            writer.writerows(rows)
-        output_file_details.append(source_file_details)
+                if len(row) == 0:
+                    continue
+                if validation is not None:
+                    validation.check_row(row)
+                new_row = plan.normalize(row)
+
+                # Older files have bad names for hospitals, and bad lat/longs;
+                # add the county too, future proof in case they add it later
+                hos = resolver.resolve(new_row[plan.name_pos])
+                if hos is None:
+                    print(f"{source_data_file}: " + new_row[plan.name_pos] + " has no location information!")
+                    if validation is not None:
+                        # the rest of the file is still checked, so the report
+                        # lists every unknown name rather than just this one
+                        for row in reader:
+                            if len(row) > 0:
+                                validation.check_row(row)
+                    raise ValueError(f"no location information for {new_row[plan.name_pos]}")
+                new_row[plan.name_pos] = hos["HospitalName"]
+                new_row[plan.lat_pos] = hos["HospitalLatitude"]
+                new_row[plan.long_pos] = hos["HospitalLongitude"]
+                if not plan.county_from_source:
+                    new_row[plan.county_pos] = hos["HospitalCounty"]
+                new_row.append(hos["HospitalCounty"])
+
+                for writer, positions, columns in writers:
+                    out_row = [new_row[pos] for pos in positions]
+                    writer.writerow(out_row)
+                    if columns is not None:
+                        for column, value in zip(columns, out_row):
+                            column.append(value)
+        except BaseException:
+            stack.close()
+            for tmp_path in tmp_paths.values():
+                os.remove(tmp_path)
+            if validation is not None and validation.header_result is not None:
+                validation.finish()
+            raise
+
+    for name, output_path in output_paths.items():
+        os.replace(tmp_paths[name], output_path)
+        if name in cache_keys:
+            cache.put(cache_keys[name], output_path)
+        # don't leave a columnar copy from an earlier run behind to be read
+        # in place of the new CSV
+        if name not in columnar_paths and os.path.exists(get_columnar_path(output_path)):
+            os.remove(get_columnar_path(output_path))
+
+    for name, (header, columns) in columnar_outputs.items():
+        write_columnar(columnar_paths[name], header, columns)
+        if name in cache_keys:
+            cache.put(cache_keys[name], columnar_paths[name], ext=".parquet")
+
+    if validation is not None:
+        validation_result = validation.finish()
+        for details in output_file_details.values():
+            details["validation"] = validation_result
     return output_file_details
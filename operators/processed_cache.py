@@ -0,0 +1,106 @@
+import os
+import json
+import shutil
+import hashlib
+
+import header_mapping
+from geo_utils import HospitalLocations
+from operators.utils import hash_file, atomic_write
+
+# bump this whenever process_csv changes what it writes for the same inputs
+PROCESSING_VERSION = "1"
+
+
+def get_processing_fingerprint():
+    """Hash of everything besides the source file that decides what
+    process_csv writes: the header mapping, the geocode cache and the hospital
+    name aliases."""
+
+    h = hashlib.sha256()
+    h.update(PROCESSING_VERSION.encode("utf8"))
+    h.update(json.dumps(header_mapping.hos_mapping, sort_keys=True).encode("utf8"))
+    h.update(hash_file(os.path.join("geo_data", "geocode_cache.csv")).encode("utf8"))
+    h.update(json.dumps(HospitalLocations.aliases, sort_keys=True).encode("utf8"))
+    return h.hexdigest()
+
+
+class ProcessedCache(object):
+    """Content-addressed store of process_csv outputs. An entry is keyed by the
+    hash of the source file, the processing fingerprint and the columns wanted,
+    so changing any of those only misses the entries it affects. Least
+    recently used entries are evicted once the cache grows past max_bytes."""
+
+    def __init__(self, cache_dir, max_bytes=200 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprint = get_processing_fingerprint()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def make_key(self, source_hash, columns_wanted):
+        h = hashlib.sha256()
+        h.update(source_hash.encode("utf8"))
+        h.update(self.fingerprint.encode("utf8"))
+        h.update(json.dumps(sorted(columns_wanted)).encode("utf8"))
+        return h.hexdigest()
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.cache_dir, key + ext)
+
+    def get(self, key, output_path, ext=".csv"):
+        """Materializes the cached output for key at output_path. Returns False
+        on a miss. ext tells apart the files cached for the same key, e.g. a
+        processed CSV and its columnar intermediate."""
+
+        entry_path = self._entry_path(key, ext)
+        try:
+            # mark as recently used
+            os.utime(entry_path)
+        except FileNotFoundError:
+            return False
+
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        try:
+            os.link(entry_path, output_path)
+        except FileNotFoundError:
+            # evicted in the meantime
+            return False
+        except OSError:
+            shutil.copyfile(entry_path, output_path)
+        return True
+
+    def put(self, key, output_path, ext=".csv"):
+        # outputs are always replaced rather than rewritten in place, so the
+        # cache entry can share the output's inode
+        with atomic_write(self._entry_path(key, ext)) as tmp_path:
+            os.remove(tmp_path)
+            try:
+                os.link(output_path, tmp_path)
+            except OSError:
+                shutil.copyfile(output_path, tmp_path)
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in
+        max_bytes."""
+
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".part"):
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+            total += st.st_size
+
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -1,7 +1,45 @@
+import os
 import json
+import hashlib
+import tempfile
+from contextlib import contextmanager
 from datetime import datetime
 
 
+def hash_file(path, blocksize=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+@contextmanager
+def atomic_write(path, prefix=None):
+    """Yields a temporary path next to path for the caller to write; once the
+    block completes it is renamed to path, so a partial file is never left
+    behind under the real name. If the block raises, the temporary file is
+    removed instead."""
+
+    fd, tmp_path = tempfile.mkstemp(prefix=prefix, suffix=".part", dir=os.path.dirname(os.path.abspath(path)))
+    os.close(fd)
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def open_csv_file(path):
+    """Default opener for CSV sources; anything with the same signature that
+    returns a text file object (e.g. Ingester.open_sftp_file) can be used in
+    its place."""
+
+    return open(path, newline='', encoding="utf8")
+
+
 def get_datetime_from_filename(filename, prefix="HOS_ResourceCapacity_"):
     source_date = filename.split('.')[0]
     source_date = source_date.replace(prefix,'')
@@ -0,0 +1,96 @@
+import traceback
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class StageFailed(Exception):
+    """Raised by StageGraph.run() once every stage that could run has, if any
+    failed. errors maps the failed stages to their exceptions; skipped lists
+    the stages that didn't run because something they need failed."""
+
+    def __init__(self, errors, skipped):
+        message = f"{len(errors)} stage(s) failed: {', '.join(errors)}"
+        if len(skipped) > 0:
+            message += f"; skipped: {', '.join(skipped)}"
+        super().__init__(message)
+        self.errors = errors
+        self.skipped = skipped
+
+
+class StageGraph(object):
+    """Runs stages as soon as the stages they need have finished, up to
+    max_workers at a time, so the whole graph takes about as long as its
+    longest chain. A stage is called with the results of the stages it
+    requires, in the order given, and its own result is passed on to the
+    stages that require it.
+
+    When a stage fails only the stages downstream of it are skipped; the
+    other branches carry on, and the failure is raised at the end."""
+
+    def __init__(self, max_workers=4):
+        self.max_workers = max_workers
+        # name -> (func, requires), in the order added
+        self.stages = {}
+
+    def add(self, name, func, requires=()):
+        """Adds a stage. The stages it requires must already have been added,
+        which keeps the graph free of cycles."""
+
+        if name in self.stages:
+            raise ValueError(f"stage {name} was already added")
+        for r in requires:
+            if r not in self.stages:
+                raise ValueError(f"stage {name} requires unknown stage {r}")
+        self.stages[name] = (func, tuple(requires))
+
+    def run(self):
+        """Runs every stage and returns their results by name."""
+
+        results = {}
+        errors = {}
+        skipped = []
+        waiting = list(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+
+            def submit_ready():
+                # stages are in the order added, so a skip reaches everything
+                # downstream of it in one pass
+                for name in list(waiting):
+                    func, requires = self.stages[name]
+                    if any(r in errors or r in skipped for r in requires):
+                        waiting.remove(name)
+                        skipped.append(name)
+                        print(f"{name}: skipped, a stage it requires failed")
+                    elif all(r in results for r in requires):
+                        waiting.remove(name)
+                        args = [results[r] for r in requires]
+                        running[executor.submit(run_stage, name, func, args)] = name
+
+            submit_ready()
+            while len(running) > 0:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as e:
+                        errors[name] = e
+                submit_ready()
+
+        if len(errors) > 0:
+            raise StageFailed(errors, skipped) from next(iter(errors.values()))
+        return results
+
+
+def run_stage(name, func, args):
+    a = datetime.now()
+    try:
+        result = func(*args)
+    except Exception:
+        print(f"{name}: failed after {datetime.now() - a}")
+        traceback.print_exc()
+        raise
+    print(f"{name}: {datetime.now() - a}")
+    return result
@@ -0,0 +1,67 @@
+import re
+import sys
+import argparse
+import subprocess
+
+# python -X importtime lines look like:
+# import time:       self [us] |  cumulative | imported package
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def measure_imports(module):
+    """Imports module in a fresh interpreter with -X importtime. Returns the
+    seconds the import took, [(cumulative seconds, self seconds, name)] for
+    each module it imported directly, and the names of every module imported
+    along the way."""
+
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{proc.stderr}")
+
+    # a module's line comes after the lines of everything it imported, which
+    # are indented two more spaces per level
+    subtree = []
+    for line in proc.stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if m is None:
+            continue
+        self_us, cumulative_us, indent, name = m.groups()
+        if len(indent) > 1:
+            subtree.append((len(indent), int(cumulative_us) / 1e6, int(self_us) / 1e6, name))
+        elif name == module:
+            total = int(cumulative_us) / 1e6
+            break
+        else:
+            # interpreter startup, not part of the module
+            subtree = []
+    else:
+        raise RuntimeError(f"no import time reported for {module}")
+
+    entries = sorted(((c, s, name) for depth, c, s, name in subtree if depth == 3), reverse=True)
+    imported = set(name for depth, c, s, name in subtree)
+    return total, entries, imported
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Reports the import cost of the Cloud Function entry point.")
+    parser.add_argument("--module", default="main", help="module to import (default: main)")
+    parser.add_argument("--top", type=int, default=15, help="number of most expensive imports to list")
+    parser.add_argument("--budget", type=float,
+                        help="seconds the import may take; exit with an error if it takes longer")
+    args = parser.parse_args()
+
+    total, entries, imported = measure_imports(args.module)
+    print(f"importing {args.module} took {total:.3f}s")
+    print(f"{'cumulative':>12} {'self':>10}  module")
+    for cumulative, self_time, name in entries[:args.top]:
+        print(f"{cumulative:>11.3f}s {self_time:>9.3f}s  {name}")
+
+    for heavy in ["pandas", "pysftp", "arcgis", "geopy"]:
+        if heavy in imported:
+            print(f"warning: {heavy} is imported at startup")
+
+    if args.budget is not None and total > args.budget:
+        print(f"over budget: {total:.3f}s > {args.budget:.3f}s")
+        sys.exit(1)
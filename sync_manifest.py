@@ -0,0 +1,205 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from operators.utils import hash_file
+
+
+class SyncManifest(object):
+    """Local record of the files on the SFTP server: size, mtime, content hash,
+    download state, and which datasets each file has been published to. Stored
+    as a SQLite database in the data dir so a run doesn't have to rescan the
+    local directory or ask ArcGIS what has already been processed.
+
+    It also keeps a ledger of rows that failed to upload, keyed by dataset,
+    source file and hospital, so later runs can retry just those rows. A file
+    with rows in the ledger is published but not fully processed. Rows whose
+    upload outcome is unknown are kept with the number of rows the table
+    should hold for their file and hospital besides them, so a later run can
+    count the table to find out which of them were added before sending any
+    again."""
+
+    def __init__(self, datadir, filename="sync_manifest.sqlite"):
+        self.path = os.path.join(datadir, filename)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self.lock, self.conn:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS remote_files (
+                    filename TEXT PRIMARY KEY,
+                    size INTEGER,
+                    mtime INTEGER,
+                    sha256 TEXT,
+                    state TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS published (
+                    filename TEXT NOT NULL,
+                    dataset_name TEXT NOT NULL,
+                    source_timestamp TEXT,
+                    published_at TEXT NOT NULL,
+                    PRIMARY KEY (filename, dataset_name)
+                )""")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS failed_rows (
+                    dataset_name TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    hospital TEXT NOT NULL,
+                    attributes TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    expected_in_table INTEGER,
+                    PRIMARY KEY (dataset_name, filename, hospital)
+                )""")
+            columns = [r[1] for r in self.conn.execute("PRAGMA table_info(failed_rows)")]
+            if "expected_in_table" not in columns:
+                # ledgers from before rows with an unknown outcome were kept
+                self.conn.execute("ALTER TABLE failed_rows ADD COLUMN expected_in_table INTEGER")
+
+    def close(self):
+        self.conn.close()
+
+    def record_remote_file(self, filename, size, mtime):
+        """Records the listing attributes of a remote file. If the size or
+        mtime changed since it was last seen, the file is marked as needing
+        to be downloaded again."""
+
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT size, mtime FROM remote_files WHERE filename = ?", (filename,)).fetchone()
+            if row is None:
+                self.conn.execute(
+                    "INSERT INTO remote_files (filename, size, mtime, state, updated_at) VALUES (?, ?, ?, 'listed', ?)",
+                    (filename, size, mtime, now))
+            elif tuple(row) != (size, mtime):
+                self.conn.execute(
+                    "UPDATE remote_files SET size = ?, mtime = ?, sha256 = NULL, state = 'listed', updated_at = ? "
+                    "WHERE filename = ?",
+                    (size, mtime, now, filename))
+
+    def is_downloaded(self, filename):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT state FROM remote_files WHERE filename = ?", (filename,)).fetchone()
+        return row is not None and row[0] == "downloaded"
+
+    def mark_downloaded(self, filename, sha256):
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "UPDATE remote_files SET sha256 = ?, state = 'downloaded', updated_at = ? WHERE filename = ?",
+                (sha256, now, filename))
+
+    def get_sha256(self, filename):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT sha256 FROM remote_files WHERE filename = ?", (filename,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def mark_published(self, dataset_name, file_details):
+        """file_details is a list of dicts with at least "filename" and
+        "source_datetime" keys, as returned by Ingester.get_files_from_sftp()."""
+
+        now = datetime.utcnow().isoformat()
+        rows = []
+        for f in file_details:
+            source_datetime = f.get("source_datetime")
+            source_timestamp = source_datetime.isoformat() if source_datetime is not None else None
+            rows.append((f["filename"], dataset_name, source_timestamp, now))
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO published (filename, dataset_name, source_timestamp, published_at) "
+                "VALUES (?, ?, ?, ?)", rows)
+
+    def has_dataset(self, dataset_name):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM published WHERE dataset_name = ? LIMIT 1", (dataset_name,)).fetchone()
+        return row is not None
+
+    def get_published_files(self, dataset_name, include_failed=False):
+        """Files fully processed into dataset_name: published, with no rows
+        left in the failure ledger. With include_failed, files that still
+        have rows in the ledger are returned too."""
+
+        if include_failed:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT filename FROM published WHERE dataset_name = ? ORDER BY filename ASC",
+                    (dataset_name,)).fetchall()
+            return [r[0] for r in rows]
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT filename FROM published WHERE dataset_name = ? AND filename NOT IN "
+                "(SELECT filename FROM failed_rows WHERE dataset_name = ?) ORDER BY filename ASC",
+                (dataset_name, dataset_name)).fetchall()
+        return [r[0] for r in rows]
+
+    def record_failed_rows(self, dataset_name, failed_rows):
+        """failed_rows is a list of (filename, hospital, attributes) for rows
+        that didn't upload. A row already in the ledger has its attempts
+        counted up."""
+
+        self._record_rows(dataset_name, [(filename, hospital, attributes, None)
+                                         for filename, hospital, attributes in failed_rows])
+
+    def record_unknown_rows(self, dataset_name, unknown_rows):
+        """unknown_rows is a list of (filename, hospital, attributes,
+        expected_in_table) for rows that may or may not have been added;
+        expected_in_table is how many rows the table should hold for the
+        file and hospital besides the unknown ones."""
+
+        self._record_rows(dataset_name, unknown_rows)
+
+    def _record_rows(self, dataset_name, rows):
+        now = datetime.utcnow().isoformat()
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO failed_rows "
+                "(dataset_name, filename, hospital, attributes, attempts, updated_at, expected_in_table) "
+                "VALUES (?, ?, ?, ?, COALESCE((SELECT attempts FROM failed_rows "
+                "WHERE dataset_name = ? AND filename = ? AND hospital = ?), 0) + 1, ?, ?)",
+                [(dataset_name, filename, hospital, json.dumps(attributes), dataset_name, filename, hospital, now,
+                  expected_in_table)
+                 for filename, hospital, attributes, expected_in_table in rows])
+
+    def get_failed_rows(self, dataset_name):
+        """Returns (filename, hospital, attributes, attempts) for every row in
+        the ledger for dataset_name that is known not to have been added."""
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT filename, hospital, attributes, attempts FROM failed_rows WHERE dataset_name = ? "
+                "AND expected_in_table IS NULL ORDER BY filename ASC, hospital ASC",
+                (dataset_name,)).fetchall()
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def get_unknown_rows(self, dataset_name):
+        """Returns (filename, hospital, attributes, expected_in_table) for
+        every row in the ledger for dataset_name whose outcome is unknown."""
+
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT filename, hospital, attributes, expected_in_table FROM failed_rows WHERE dataset_name = ? "
+                "AND expected_in_table IS NOT NULL ORDER BY filename ASC, hospital ASC",
+                (dataset_name,)).fetchall()
+        return [(r[0], r[1], json.loads(r[2]), r[3]) for r in rows]
+
+    def clear_failed_rows(self, dataset_name, keys):
+        """Removes rows, given as (filename, hospital), once they have been
+        uploaded."""
+
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM failed_rows WHERE dataset_name = ? AND filename = ? AND hospital = ?",
+                [(dataset_name, filename, hospital) for filename, hospital in keys])
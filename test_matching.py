@@ -1,16 +1,23 @@
 import os
 import csv
 import glob
+import json
 import argparse
 import header_mapping as hm
 from header_mapping import HeaderMapping
 from operators.utils import load_geojson
-from validator import CSVValidator
+from validator import validate_files
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--dir")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="number of processes to validate files with")
+    parser.add_argument("--cache",
+                        help="file that keeps verdicts between runs (default: .validation_cache.json in --dir); "
+                             "pass '' to disable")
+    parser.add_argument("--report", help="write the results for every file to this JSON file")
     args = parser.parse_args()
 
     if args.dir is not None:
@@ -18,11 +25,16 @@ if __name__ == "__main__":
     else:
         dirpath = "data"
 
-    hos_csvs = glob.glob(os.path.join(dirpath, "HOS*.csv"))
+    hos_csvs = sorted(glob.glob(os.path.join(dirpath, "HOS*.csv")))
     print(f"validating {len(hos_csvs)} HOS file(s)")
-    hos_validator = CSVValidator("HOS")
-    for hos in hos_csvs:
-        result = hos_validator.validate_csv(hos)
+    if args.cache is None:
+        cache_path = os.path.join(dirpath, ".validation_cache.json")
+    elif args.cache == "":
+        cache_path = None
+    else:
+        cache_path = args.cache
+    results = validate_files(hos_csvs, "HOS", workers=args.workers, cache_path=cache_path)
+    for hos, result in results.items():
         if result['pass']:
             print(os.path.basename(hos), "pass: True")
         else:
@@ -35,6 +47,11 @@ if __name__ == "__main__":
             #     print(f"'{error}'")
         # print(result)
 
+    if args.report is not None:
+        report = {os.path.basename(hos): result for hos, result in results.items()}
+        with open(args.report, "w") as openf:
+            openf.write(json.dumps(report, indent=2))
+
     # ltc_csvs = glob.glob(os.path.join(dirpath, "LTC*.csv"))
     # print(f"validating {len(ltc_csvs)} LTC file(s)")
     # ltc_validator = CSVValidator("LTC")
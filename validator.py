@@ -1,7 +1,15 @@
 import os
 import csv
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import header_mapping
 from header_mapping import HeaderMapping
-from operators.utils import load_geojson
+from operators.utils import open_csv_file, hash_file, atomic_write
+from operators.facility_index import load_facility_index
+
+# bump this whenever the checks change, to invalidate cached verdicts
+VALIDATION_VERSION = "1"
 
 
 class ValidationError(Exception):
@@ -23,45 +31,40 @@ class CSVValidator():
 
         if self.type == "HOS":
             gj = os.path.join("geo_data", "HOS_locations.geojson")
+            self.mapping = header_mapping.hos_mapping
             self.loc_name_field = "hospitalName"  # in the csv
             self.loc_name_field_historical = "HospitalName"  # in the csv
             self.loc_name_prop = "HospitalName"  # in the geojson
             self.loc_alias_prop = "HospitalNameAliases"   # in the geojson
         if self.type == "LTC":
             gj = os.path.join("geo_data", "LTC_locations.geojson")
+            self.mapping = header_mapping.ltc_mapping
             self.loc_name_field = "LTCName"
             self.loc_name_field_historical = "LTCName" # Just in case it's needed
             self.loc_name_prop = "LTCName"  # in the geojson
             self.loc_alias_prop = "LTCNameAliases"
 
-        self.loc_lookup = load_geojson(gj, self.loc_name_prop)
+        self.geojson_path = gj
+        self.loc_index = load_facility_index(gj, self.loc_name_prop, self.loc_alias_prop)
+
+    def match_location(self, name):
+        """True if name (already stripped) is a known facility name or alias."""
+
+        return name in self.loc_index
 
-    def validate_locations(self, input_csv):
+    def validate_locations(self, input_csv, open_csv=open_csv_file):
 
         location_fails = []
-        with open(input_csv, "r", encoding="utf-8") as openf:
+        with open_csv(input_csv) as openf:
             reader = csv.DictReader(openf)
 
             for row in reader:
-                geomatch = None
                 try:
                     name = row[self.loc_name_field].strip()
                 except KeyError:
                     name = row[self.loc_name_field_historical].strip()
 
-                # match attempt 1: does the name match?
-                if name in self.loc_lookup:
-                    geomatch = self.loc_lookup[name]
-
-                # match attempt 2: iterate all possible aliases in lookup
-                else:
-                    for k, v in self.loc_lookup.items():
-                        aliases = v[self.loc_alias_prop]
-                        if aliases is None:
-                            continue
-                        if name in aliases.split("|"):
-                            geomatch = v
-                if geomatch is None:
+                if not self.match_location(name):
                     location_fails.append(name)
 
         result = {
@@ -70,11 +73,7 @@ class CSVValidator():
         }
         return result
 
-    def validate_headers(self, input_csv):
-
-        with open(input_csv, "r") as openf:
-            reader = csv.reader(openf)
-            csv_headers = next(reader)
+    def check_headers(self, csv_headers):
 
         result = True
         missing = [i for i in csv_headers if i not in self.valid_headers]
@@ -87,17 +86,50 @@ class CSVValidator():
         }
         return result
 
-    def validate_csv(self, input_csv, raise_exception=False):
+    def validate_headers(self, input_csv, open_csv=open_csv_file):
 
-        header_result = self.validate_headers(input_csv)
-        location_result = self.validate_locations(input_csv)
+        with open_csv(input_csv) as openf:
+            reader = csv.reader(openf)
+            csv_headers = next(reader)
 
-        result = {
+        return self.check_headers(csv_headers)
+
+    def validate_csv(self, input_csv, raise_exception=False, open_csv=open_csv_file):
+
+        header_result = self.validate_headers(input_csv, open_csv=open_csv)
+        location_result = self.validate_locations(input_csv, open_csv=open_csv)
+
+        return self.report(input_csv, header_result, location_result, raise_exception=raise_exception)
+
+    def begin(self, input_csv):
+        """Starts a validation that is fed by another pass over input_csv
+        rather than reading the file itself; see StreamingValidation."""
+
+        return StreamingValidation(self, input_csv)
+
+    def get_fingerprint(self):
+        """Hash of what a verdict depends on besides the file itself: the
+        geojson and header mapping it is checked against."""
+
+        h = hashlib.sha256()
+        h.update(VALIDATION_VERSION.encode("utf8"))
+        h.update(self.type.encode("utf8"))
+        h.update(hash_file(self.geojson_path).encode("utf8"))
+        h.update(json.dumps(self.mapping, sort_keys=True).encode("utf8"))
+        return h.hexdigest()
+
+    def combine(self, header_result, location_result):
+
+        return {
             "pass": header_result['pass'] and location_result['pass'],
             "header_errors": header_result['errors'],
             "location_errors": location_result['errors'],
         }
 
+    def report(self, input_csv, header_result, location_result, raise_exception=False):
+
+        result = self.combine(header_result, location_result)
+
         if result['pass'] is False:
             fname = os.path.basename(input_csv)
             h_er_str = '|'.join(result['header_errors'])
@@ -114,3 +146,102 @@ class CSVValidator():
                 print(report)
 
         return result
+
+
+class StreamingValidation():
+    """The checks of CSVValidator.validate_csv(), run as hooks inside some other
+    read of the file (process_csv's) instead of two extra passes over it. Call
+    check_headers() with the header row, check_row() with every csv.reader
+    row after it, then finish() for the same result validate_csv() gives."""
+
+    def __init__(self, validator, input_csv):
+        self.validator = validator
+        self.input_csv = input_csv
+        self.header_result = None
+        self.name_index = None
+        self.location_fails = []
+
+    def check_headers(self, csv_headers):
+        self.header_result = self.validator.check_headers(csv_headers)
+
+        # a repeated header takes the value of its last occurrence, as with DictReader
+        last_index = {h: i for i, h in enumerate(csv_headers)}
+        if self.validator.loc_name_field in last_index:
+            self.name_index = last_index[self.validator.loc_name_field]
+        elif self.validator.loc_name_field_historical in last_index:
+            self.name_index = last_index[self.validator.loc_name_field_historical]
+
+    def check_row(self, row):
+        if self.name_index is None:
+            raise KeyError(self.validator.loc_name_field_historical)
+        name = row[self.name_index].strip() if self.name_index < len(row) else ""
+        if not self.validator.match_location(name):
+            self.location_fails.append(name)
+
+    def finish(self, raise_exception=False):
+        location_result = {
+            "pass": len(self.location_fails) == 0,
+            "errors": self.location_fails
+        }
+        return self.validator.report(self.input_csv, self.header_result, location_result,
+                                     raise_exception=raise_exception)
+
+
+# loaded once per worker process by init_worker()
+worker_validator = {}
+
+def init_worker(validation_type):
+    worker_validator["v"] = CSVValidator(validation_type)
+
+def validate_in_worker(input_csv):
+    v = worker_validator["v"]
+    return v.combine(v.validate_headers(input_csv), v.validate_locations(input_csv))
+
+
+def validate_files(input_csvs, validation_type="HOS", workers=1, cache_path=None):
+    """Validates many files, spreading them over `workers` processes. With a
+    cache_path, verdicts are kept in a JSON file keyed by the hash of each file
+    plus the hash of the geojson and header mapping it was checked against, so
+    only new or changed files, or all files after a mapping or alias change,
+    are validated again. Returns a dict of input path to result, without
+    printing a report for each failure."""
+
+    v = CSVValidator(validation_type)
+    fingerprint = v.get_fingerprint()
+
+    cache = {}
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, "r") as openf:
+            cache = json.loads(openf.read())
+
+    results = {}
+    keys = {}
+    to_validate = []
+    for input_csv in input_csvs:
+        h = hashlib.sha256()
+        h.update(hash_file(input_csv).encode("utf8"))
+        h.update(fingerprint.encode("utf8"))
+        keys[input_csv] = h.hexdigest()
+        if keys[input_csv] in cache:
+            results[input_csv] = cache[keys[input_csv]]
+        else:
+            to_validate.append(input_csv)
+
+    if workers > 1 and len(to_validate) > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(validation_type,)) as executor:
+            new_results = list(executor.map(validate_in_worker, to_validate))
+    else:
+        new_results = [v.combine(v.validate_headers(f), v.validate_locations(f)) for f in to_validate]
+
+    for input_csv, result in zip(to_validate, new_results):
+        results[input_csv] = result
+        cache[keys[input_csv]] = result
+
+    if cache_path is not None and len(to_validate) > 0:
+        with atomic_write(cache_path) as tmp_path:
+            with open(tmp_path, "w") as openf:
+                openf.write(json.dumps(cache))
+
+    # same order the files were passed in
+    return {input_csv: results[input_csv] for input_csv in input_csvs}